@@ -0,0 +1,66 @@
+"""
+Microbenchmark: KneaderController.get_full_status on large recipes.
+
+Builds a controller without hardware, gateway or logger, loads a synthetic workorder of STEPS x ITEMS
+and puts it in WAITING_FOR_ITEMS with half of the current step scanned. Reports status calls per
+second when nothing changes between calls (the cached snapshot) and when the remaining mix time
+ticks before every call (a full rebuild each time, as in the mixing loop).
+
+Usage (from the kneader directory):
+    python benchmarks/bench_controller_status.py [steps] [items per step] [seconds]
+"""
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from controller import KneaderController  # noqa: E402
+
+
+def make_controller(steps: int, items: int) -> KneaderController:
+    controller = KneaderController.__new__(KneaderController)
+    controller._setup_status_tracking()
+    controller._setup_events()
+    with contextlib.redirect_stdout(io.StringIO()):
+        controller._reset_internal_state()
+    controller.workorder = {
+        "workorder_id": "BENCH", "name": "bench", "type": "bench",
+        "steps": [{"step_no": s + 1, "mix_time_sec": 60,
+                   "items": [{"item_id": f"S{s}-I{i}", "name": f"item {i}"} for i in range(items)]}
+                  for s in range(steps)],
+    }
+    controller.process_state = "WAITING_FOR_ITEMS"
+    controller.current_step_index = steps // 2
+    controller.scanned_items_by_step = {
+        s: {f"S{s}-I{i}" for i in range(0, items, 2)} for s in range(steps // 2, steps)
+    }
+    return controller
+
+
+def measure(label: str, controller: KneaderController, seconds: float, tick: bool):
+    calls = 0
+    start = time.perf_counter()
+    stop_at = start + seconds
+    while time.perf_counter() < stop_at:
+        for _ in range(100):
+            if tick:
+                controller.remaining_mix_time += 1
+            controller.get_full_status()
+        calls += 100
+    elapsed = time.perf_counter() - start
+    print(f"{label:>10}: {calls / elapsed:12,.0f} status/s  ({elapsed / calls * 1e6:10.2f} us/call)")
+
+
+def main(steps: int, items: int, seconds: float):
+    controller = make_controller(steps, items)
+    print(f"{steps} steps x {items} items")
+    measure("unchanged", controller, seconds, tick=False)
+    measure("changed", controller, seconds, tick=True)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+         float(sys.argv[3]) if len(sys.argv) > 3 else 2.0)
@@ -0,0 +1,61 @@
+"""
+Microbenchmark: gateway routing cost per command.
+
+Measures GatewayManager.route_command_to_mc end to end with the microcontroller side short-circuited:
+each command is answered as soon as it is "sent", so the numbers are pure gateway CPU cost
+(command building, correlation and response handling), not network time.
+
+Usage (from the kneader directory):
+    python benchmarks/bench_gateway_routing.py [iterations]
+"""
+import asyncio
+import contextlib
+import io
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gateway"))
+from gatewayserver import GatewayManager  # noqa: E402
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rtu_kneader_config.json")
+
+
+def attach_instant_responder(manager: GatewayManager):
+    """Replaces each MC client's send_command with one that resolves the pending request immediately."""
+    for mc_client in manager.mc_clients.values():
+        async def send_command(command, priority=None, _mc=mc_client):
+            future = _mc.pending_requests.get(command.get("req_id"))
+            if future:
+                future.set_result({"status": "ok", "value": True, "req_id": command["req_id"]})
+
+        mc_client.send_command = send_command
+        mc_client.is_connected = True
+
+
+async def run(iterations: int):
+    manager = GatewayManager(CONFIG_PATH)
+    manager.load_config()
+    attach_instant_responder(manager)
+
+    commands = [
+        {"action": "read", "tag_name": "rd_lid_status_kn1"},
+        {"action": "write", "tag_name": "wr_motor_control_kn1", "value": 1},
+    ]
+    for command in commands:
+        # Swallow any stdout chatter so we time the routing work rather than the terminal
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(100):
+                await manager.route_command_to_mc(dict(command))
+            start = time.perf_counter()
+            for _ in range(iterations):
+                await manager.route_command_to_mc(dict(command))
+            elapsed = time.perf_counter() - start
+        print(f"{command['action']:>6}: {elapsed / iterations * 1e6:8.2f} us/command  "
+              f"({iterations / elapsed:,.0f} commands/s)")
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
@@ -0,0 +1,87 @@
+"""
+Benchmark: gateway interlock reaction latency against the microcontroller simulator.
+
+Runs the simulator and a GatewayManager (MC links only) on loopback with the rule
+"rd_lid_status_kn1 == 0 -> wr_motor_control_kn1 = 0". Each round turns the motor on, makes the
+simulator report the lid opening, and times how long it takes until the simulator receives the
+motor-off write: interrupt out, gateway evaluation, write back in.
+
+Usage (from the kneader directory):
+    python benchmarks/bench_interlock_latency.py [rounds]
+"""
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+KNEADER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(KNEADER_DIR, "gateway"))
+sys.path.insert(0, os.path.join(KNEADER_DIR, "simulator"))
+from gatewayserver import GatewayManager  # noqa: E402
+from micro_simulator import KneaderSimulator  # noqa: E402
+
+RULE = {"lid_open_stops_motor": "rd_lid_status_kn1 == 0 -> wr_motor_control_kn1 = 0"}
+
+
+async def run(rounds: int):
+    simulator = KneaderSimulator()
+    server = await asyncio.start_server(simulator.handle_client, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    # Point every tag of the shipped RTU config at the simulator
+    with open(os.path.join(KNEADER_DIR, "rtu_kneader_config.json")) as f:
+        tags = json.load(f)
+    for tag in tags:
+        tag["micro_controller_ip"], tag["micro_controller_port"] = "127.0.0.1", port
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(tags, f)
+
+    manager = GatewayManager(f.name, {}, RULE)
+    manager.load_config()
+    mc_tasks = [asyncio.create_task(mc.run()) for mc in manager.mc_clients.values()]
+    while not all(mc.is_connected for mc in manager.mc_clients.values()):
+        await asyncio.sleep(0.01)
+
+    motor_stopped = None
+    execute = simulator._execute_command
+
+    async def spy(command):
+        if command.get("cmd") == "write" and str(command.get("pin")) == "3" and not command.get("value"):
+            if motor_stopped and not motor_stopped.done():
+                motor_stopped.set_result(time.perf_counter())
+        return await execute(command)
+
+    simulator._execute_command = spy
+
+    latencies = []
+    for _ in range(rounds):
+        simulator.device_states["3"] = simulator.device_states["2"] = True
+        motor_stopped = asyncio.get_running_loop().create_future()
+        started_at = time.perf_counter()
+        await simulator.notify_pin_change("1", False)  # Lid opens while the motor runs
+        latencies.append((await asyncio.wait_for(motor_stopped, timeout=2.0) - started_at) * 1000.0)
+        await simulator.notify_pin_change("1", True)
+        await asyncio.sleep(0.01)
+
+    latencies.sort()
+    print(f"interlock reaction over {rounds} rounds: p50 {statistics.median(latencies):.2f} ms, "
+          f"p99 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]:.2f} ms, "
+          f"max {latencies[-1]:.2f} ms  (fired {manager.interlock_stats['fired']})")
+
+    for task in mc_tasks:
+        task.cancel()
+    await asyncio.gather(*mc_tasks, return_exceptions=True)
+    await asyncio.sleep(0.05)  # Let the simulator see the disconnect
+    for task in asyncio.all_tasks() - {asyncio.current_task()}:
+        task.cancel()  # Simulated motor/lid movements still in progress
+    server.close()
+    os.unlink(f.name)
+
+
+if __name__ == "__main__":
+    logging.disable(logging.WARNING)
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 200))
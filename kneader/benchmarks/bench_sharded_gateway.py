@@ -0,0 +1,157 @@
+"""
+Benchmark: gateway throughput with the MCs sharded over 1, 2, 4 ... worker processes.
+
+Starts one microcontroller simulator process per kneader and an RTU config with the shipped tags
+repeated for each of them (tag names suffixed _m<i>). For each worker count, the gateway runs in its
+own process (a plain GatewayManager for 1, a GatewayRouter with its shard workers otherwise) and
+client processes, one per kneader, keep WINDOW tagged writes to the beep/alarm pins in flight on their
+kneader. Reported is the total number of completed writes per second. Scaling needs free cores for
+the workers, the simulators and the clients, so run it on a machine with more cores than workers.
+
+Usage (from the kneader directory):
+    python benchmarks/bench_sharded_gateway.py [kneaders] [worker counts, e.g. 1,2,4] [seconds]
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+KNEADER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, KNEADER_DIR)
+sys.path.insert(0, os.path.join(KNEADER_DIR, "gateway"))
+sys.path.insert(0, os.path.join(KNEADER_DIR, "simulator"))
+from utils.wire_codec import negotiate_codec  # noqa: E402
+from gatewayserver import GatewayManager, GatewayRouter  # noqa: E402
+from micro_simulator import KneaderSimulator  # noqa: E402
+
+WINDOW = 32
+WRITE_TAGS = ("wr_beep_kn1", "wr_alarm_kn1")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_simulator(port: int):
+    logging.disable(logging.WARNING)
+    asyncio.run(KneaderSimulator().start_server("127.0.0.1", port))
+
+
+def run_gateway(config_path: str, options: dict):
+    logging.disable(logging.WARNING)
+    sharded = int(options.get("shard_workers", 1)) > 1
+    try:
+        asyncio.run((GatewayRouter if sharded else GatewayManager)(config_path, options).start())
+    except KeyboardInterrupt:
+        pass
+
+
+def run_client(port: int, kneader: int, seconds: float, results):
+    async def drive():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        codec = await negotiate_codec(reader, writer, {"action": "hello"}, ["msgpack", "cbor"])
+        tags = [f"{tag}_m{kneader}" for tag in WRITE_TAGS]
+        sent = done = errors = 0
+
+        def send():
+            nonlocal sent
+            writer.write(codec.encode({"action": "write", "tag_name": tags[sent % len(tags)],
+                                       "value": sent % 2, "req_id": sent}))
+            sent += 1
+
+        for _ in range(WINDOW):
+            send()
+        stop_at = time.perf_counter() + seconds
+        while time.perf_counter() < stop_at:
+            response = await codec.read(reader)
+            if "req_id" not in response:
+                continue  # An event
+            done += 1
+            errors += response.get("status") != "ok"
+            send()
+            if sent % WINDOW == 0:
+                await writer.drain()
+        writer.close()
+        results.put((done, errors))
+
+    logging.disable(logging.WARNING)
+    asyncio.run(drive())
+
+
+def wait_for_port(port: int, timeout: float = 20.0):
+    give_up_at = time.monotonic() + timeout
+    while time.monotonic() < give_up_at:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Nothing listening on port {port}")
+
+
+def run_mode(config_path: str, kneaders: int, workers: int, seconds: float):
+    ctx = multiprocessing.get_context("spawn")
+    port = free_port()
+    options = {"gateway_server_ip": "127.0.0.1", "gateway_server_port": str(port), "shard_workers": str(workers),
+               "shard_base_port": str(free_port()), "config_watch_interval": "0",
+               "log_level": "WARNING"}
+    gateway = ctx.Process(target=run_gateway, args=(config_path, options))
+    gateway.start()
+    wait_for_port(port)
+    time.sleep(1.0 + 0.5 * workers)  # Shard workers and MC links coming up
+
+    results = ctx.Queue()
+    clients = [ctx.Process(target=run_client, args=(port, kneader, seconds, results), daemon=True)
+               for kneader in range(kneaders)]
+    for client in clients:
+        client.start()
+    totals = [results.get(timeout=seconds + 30) for _ in clients]
+    for client in clients:
+        client.join()
+    os.kill(gateway.pid, signal.SIGINT)  # Lets a router stop its shard workers
+    gateway.join()
+
+    done, errors = sum(t[0] for t in totals), sum(t[1] for t in totals)
+    print(f"{workers:>2} worker(s): {done / seconds:10,.0f} writes/s  ({errors} errors, {kneaders} kneaders)")
+
+
+def main(kneaders: int, worker_counts, seconds: float):
+    ctx = multiprocessing.get_context("spawn")
+    with open(os.path.join(KNEADER_DIR, "rtu_kneader_config.json")) as f:
+        shipped = json.load(f)
+    sim_ports = [free_port() for _ in range(kneaders)]
+    tags = []
+    for kneader, sim_port in enumerate(sim_ports):
+        for tag in shipped:
+            tags.append({**tag, "tag_name": f"{tag['tag_name']}_m{kneader}",
+                         "micro_controller_ip": "127.0.0.1", "micro_controller_port": sim_port})
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(tags, f)
+
+    simulators = [ctx.Process(target=run_simulator, args=(sim_port,), daemon=True) for sim_port in sim_ports]
+    for simulator in simulators:
+        simulator.start()
+    for sim_port in sim_ports:
+        wait_for_port(sim_port)
+    try:
+        for workers in worker_counts:
+            run_mode(f.name, kneaders, workers, seconds)
+    finally:
+        for simulator in simulators:
+            simulator.terminate()
+        os.unlink(f.name)
+
+
+if __name__ == "__main__":
+    logging.disable(logging.WARNING)
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 8,
+         [int(n) for n in sys.argv[2].split(",")] if len(sys.argv) > 2 else [1, 2, 4],
+         float(sys.argv[3]) if len(sys.argv) > 3 else 5.0)
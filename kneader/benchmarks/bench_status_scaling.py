@@ -0,0 +1,38 @@
+"""
+Benchmark: status rebuild latency against recipe size, up to 200 steps x 50 items.
+
+Uses the synthetic controller of bench_controller_status with every item but one of the current step
+scanned (the worst case for the WAITING_FOR_ITEMS "all scanned?" check) and ticks the remaining mix
+time before each call, so every get_full_status is a full rebuild.
+
+Usage (from the kneader directory):
+    python benchmarks/bench_status_scaling.py [calls per size]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_controller_status import make_controller  # noqa: E402
+
+SIZES = ((10, 10), (50, 20), (100, 50), (200, 50))
+
+
+def measure(steps: int, items: int, calls: int):
+    controller = make_controller(steps, items)
+    current = controller.current_step_index
+    for i in range(1, items):
+        controller._record_scan(current, f"S{current}-I{i}")
+    controller.get_full_status()
+    start = time.perf_counter()
+    for _ in range(calls):
+        controller.remaining_mix_time += 1
+        controller.get_full_status()
+    elapsed = time.perf_counter() - start
+    print(f"{steps:>4} steps x {items:>3} items: {elapsed / calls * 1e3:8.3f} ms/status  "
+          f"({elapsed / calls / (steps * items) * 1e9:6.1f} ns/item)")
+
+
+if __name__ == "__main__":
+    for steps, items in SIZES:
+        measure(steps, items, int(sys.argv[1]) if len(sys.argv) > 1 else 200)
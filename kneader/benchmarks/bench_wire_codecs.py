@@ -0,0 +1,79 @@
+"""
+Benchmark: messages per second and CPU per message for each wire codec, against the microcontroller simulator.
+
+Runs the simulator on a loopback port and drives it with pipelined read commands (WINDOW outstanding
+at a time), once per framing mode: JSON lines with the stdlib codec, JSON lines with orjson, and the
+length-prefixed binary codecs. Both ends run in this process, so the CPU figure covers encoding and
+decoding on both sides of the link. Modes whose library is not installed are skipped.
+
+Usage (from the kneader directory):
+    python benchmarks/bench_wire_codecs.py [messages]
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+
+KNEADER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, KNEADER_DIR)
+sys.path.insert(0, os.path.join(KNEADER_DIR, "simulator"))
+from utils import wire_codec  # noqa: E402
+from utils.wire_codec import JSON_CODEC, negotiate_codec  # noqa: E402
+from micro_simulator import KneaderSimulator  # noqa: E402
+
+WINDOW = 32
+
+
+async def run_mode(mode: str, messages: int):
+    simulator = KneaderSimulator()
+    server = await asyncio.start_server(simulator.handle_client, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    codec = JSON_CODEC
+    if mode not in ("json", "json (stdlib)"):
+        codec = await negotiate_codec(reader, writer, {"cmd": "hello"}, [mode])
+        if codec.name != mode:
+            print(f"{mode:>13}: not available")
+            await close(server, writer)
+            return
+
+    async def exchange(count: int):
+        for first in range(0, count, WINDOW):
+            batch = min(WINDOW, count - first)
+            for i in range(batch):
+                writer.write(codec.encode({"cmd": "read", "slave_id": 1, "pin": 1, "req_id": first + i}))
+            await writer.drain()
+            for _ in range(batch):
+                await codec.read(reader)
+
+    await exchange(1000)  # Warm up
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    await exchange(messages)
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    print(f"{mode:>13}: {messages / wall:10,.0f} msg/s  {cpu / messages * 1e6:7.2f} us CPU/msg  "
+          f"({len(codec.encode({'cmd': 'read', 'slave_id': 1, 'pin': 1, 'req_id': 1}))} bytes/command)")
+    await close(server, writer)
+
+
+async def close(server: asyncio.AbstractServer, writer: asyncio.StreamWriter):
+    writer.close()
+    await writer.wait_closed()
+    await asyncio.sleep(0.05)  # Let the simulator's connection handler see EOF and finish
+    server.close()
+
+
+async def run(messages: int):
+    fast_json = wire_codec.orjson
+    wire_codec.orjson = None
+    await run_mode("json (stdlib)", messages)
+    wire_codec.orjson = fast_json
+    if fast_json is not None:
+        await run_mode("json", messages)
+    for mode in wire_codec.PREFERRED_CODECS:
+        await run_mode(mode, messages)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 50000))
@@ -5,14 +5,17 @@ import time
 import os
 import re
 import configparser
-from typing import Dict, Any, Optional, Set
+from typing import Dict, Any, List, Optional, Set
 from Kneader2 import Kneader
 from utils.AsyncJsonLogger import AsyncJsonLogger
 import config
-from gateway_client import AsyncGatewayClient
+from gateway_client import AsyncGatewayClient, state_based_tags
 from datetime import datetime
 import time
 
+# Pause before a failed gateway tag watch (lid / motor flags) is started again
+WATCH_RESTART_DELAY_SEC = 1.0
+
 def log_ctrl(msg, req_id=None):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
     if req_id:
@@ -21,6 +24,18 @@ def log_ctrl(msg, req_id=None):
         print(f"{ts} [CTRL] {msg}", flush=True)
 
 
+class StatusSnapshot(dict):
+    """Read-only status dict: get_full_status hands the same one to every caller until the status changes."""
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Status snapshots are read-only")
+
+    __setitem__ = __delitem__ = update = pop = popitem = setdefault = clear = _read_only
+
+
+_UNSET = object()
+
+
 class KneaderController:
 
     def log_ctrl(msg, req_id=None):
@@ -30,7 +45,18 @@ class KneaderController:
         else:
             print(f"{ts} [CTRL] {msg}", flush=True)
 
+    # Attributes get_full_status depends on. Assigning one of the STATUS_FIELDS a different value
+    # bumps the status version; the containers are not compared (that would mean a deep compare
+    # on every assignment), so any assignment of one bumps it. In-place changes (scanned sets,
+    # prescan data) call _touch_status instead.
+    STATUS_FIELDS = frozenset({
+        "process_state", "current_step_index", "current_item_index", "lid_open", "motor_running",
+        "remaining_mix_time", "error_message", "motor_start_failed_alert",
+    })
+    STATUS_CONTAINERS = frozenset({"workorder", "_prescan_data", "scanned_items_by_step"})
+
     def __init__(self):
+        self._setup_status_tracking()
         self._setup_events()
         self._load_config()
         self._initialize_logger()
@@ -40,6 +66,18 @@ class KneaderController:
         self._prescan_data = None
         self.ready_timestamps = {}
 
+    def _setup_status_tracking(self):
+        self._status_version = 0
+        self._status_snapshot: Optional[StatusSnapshot] = None
+        self._frozen_steps = []  # (workorder step, item live statuses, read-only copy) from the last snapshot
+        # Scan bookkeeping for the current workorder, rebuilt by _workorder_index when the workorder
+        # or scanned_items_by_step is replaced
+        self._indexed_workorder = None
+        self._counted_scans = None
+        self._step_item_ids: List[frozenset] = []  # item_ids per step
+        self._item_steps: Dict[str, List[int]] = {}  # item_id → steps listing it
+        self._scan_counts: Dict[int, int] = {}  # step → number of its item_ids scanned
+
     def _setup_events(self):
         self._is_paused = asyncio.Event()
         self._confirm_start_event = asyncio.Event()
@@ -53,6 +91,7 @@ class KneaderController:
         config_parser.read(config_path)
 
         self.config_file_path = config_parser['files']['kneader_json_log_file']
+        self.rtu_config_path = config_parser['files'].get('rtu_config_file', '')
         self.completed_workorders_dir = config_parser['files'].get(
             'completed_workorders_dir',
             os.path.join(os.getcwd(), "completed_workorders")  # fallback default
@@ -65,8 +104,13 @@ class KneaderController:
         asyncio.create_task(self.logger.start())
 
     def _initialize_gateway(self):
-        self.gateway = AsyncGatewayClient(config.GATEWAY_HOST, config.GATEWAY_PORT, logger=self.logger)
-        self.gateway.event_callback = self._handle_gateway_event
+        # Subscribes to every interrupt-reported tag of the RTU config (lid & motor if it cannot be read)
+        self.gateway = AsyncGatewayClient(config.GATEWAY_HOST, config.GATEWAY_PORT, logger=self.logger,
+                                          subscribe_tags=state_based_tags(self.rtu_config_path))
+        self.gateway.start()
+        # The lid and motor flags follow the gateway's tag streams: no task or status rebuild per event
+        self._gateway_watch_tasks = [asyncio.create_task(self._watch_gateway_tag(tag_name))
+                                     for tag_name in ("rd_lid_status_kn1", "rd_motor_status_kn1")]
 
     def _initialize_kneader(self):
         self.kneader = Kneader(
@@ -91,6 +135,7 @@ class KneaderController:
         self.mixing_start_timestamp = None
         self.motor_start_failed_alert = False
         self.remaining_mix_time = 0
+        self._mix_end_schedule_id = None  # Gateway-side "motor off, lid open" at the end of mixing
         self.work_order_task = None
         self.hmi_cmd_queue = asyncio.Queue()
         self._prescan_data = None
@@ -105,26 +150,80 @@ class KneaderController:
         self.ready_timestamps = {}
         print("Controller reset: state=IDLE")
 
-    def _handle_gateway_event(self, event: Dict[str, Any]):
-        if "tag_name" in event and "value" in event:
-            if event["tag_name"] == "rd_lid_status_kn1":
-                self.lid_open = not event["value"]
-            elif event["tag_name"] == "rd_motor_status_kn1":
-                self.motor_running = event["value"]
-
-        asyncio.create_task(
-            self.logger.log(
-                "INFO",
-                f"Updated from event: lid_open={self.lid_open}, motor_running={self.motor_running}",
-                data=self.get_full_status(),
-                is_event=False
-            )
-        )
-
+    async def _watch_gateway_tag(self, tag_name: str):
+        """Keeps lid_open / motor_running following the tag; a failed watch is logged and started again."""
+        while True:
+            try:
+                async for update in self.gateway.watch(tag_name):
+                    if tag_name == "rd_lid_status_kn1":
+                        self.lid_open = not update.value
+                    else:
+                        self.motor_running = update.value
+                    await self.logger.log("INFO",
+                                          f"Updated from {update.source}: lid_open={self.lid_open}, motor_running={self.motor_running}",
+                                          data=update._asdict(), is_event=False)
+            except Exception as e:
+                # Printed rather than logged: the logger may be what failed
+                log_ctrl(f"Watching {tag_name} failed ({e!r}), restarting in {WATCH_RESTART_DELAY_SEC}s")
+                await asyncio.sleep(WATCH_RESTART_DELAY_SEC)
+
+    def __setattr__(self, name: str, value: Any):
+        if name in self.STATUS_CONTAINERS:
+            self._status_version += 1
+        elif name in self.STATUS_FIELDS and getattr(self, name, _UNSET) != value:
+            self._status_version += 1
+        super().__setattr__(name, value)
+
+    def _touch_status(self):
+        """Marks the status as changed after an in-place update the attribute hook cannot see."""
+        self._status_version += 1
+
+    def _workorder_index(self) -> Dict[str, List[int]]:
+        """The item_id → steps index of the current workorder, with per-step scan counters to match."""
+        if self._indexed_workorder is not self.workorder:
+            steps = self.workorder.get("steps", []) if self.workorder else []
+            self._step_item_ids = [frozenset(item["item_id"] for item in step.get("items", [])) for step in steps]
+            self._item_steps = {}
+            for s_idx, item_ids in enumerate(self._step_item_ids):
+                for item_id in item_ids:
+                    self._item_steps.setdefault(item_id, []).append(s_idx)
+            self._indexed_workorder = self.workorder
+            self._counted_scans = None
+        if self._counted_scans is not self.scanned_items_by_step:
+            self._scan_counts = {
+                s_idx: len(scanned & self._step_item_ids[s_idx])
+                for s_idx, scanned in self.scanned_items_by_step.items() if s_idx < len(self._step_item_ids)
+            }
+            self._counted_scans = self.scanned_items_by_step
+        return self._item_steps
 
+    def _record_scan(self, step_index: int, item_id: str):
+        """Marks item_id as scanned for step_index and keeps that step's scan counter in line."""
+        scanned = self.scanned_items_by_step.setdefault(step_index, set())
+        if item_id in scanned:
+            return
+        self._workorder_index()
+        scanned.add(item_id)
+        if step_index in self._item_steps.get(item_id, ()):
+            self._scan_counts[step_index] = self._scan_counts.get(step_index, 0) + 1
+        self._touch_status()
+
+    def _step_fully_scanned(self, step_index: int) -> bool:
+        self._workorder_index()
+        if step_index >= len(self._step_item_ids):
+            return False
+        return self._scan_counts.get(step_index, 0) == len(self._step_item_ids[step_index])
 
     def get_full_status(self) -> Dict[str, Any]:
+        """The current status; rebuilt only when something it depends on changed since the last call."""
+        snapshot = self._status_snapshot
+        if snapshot is None or snapshot["status_version"] != self._status_version:
+            snapshot = self._status_snapshot = self._build_status()
+        return snapshot
+
+    def _build_status(self) -> StatusSnapshot:
         status = {
+            "status_version": self._status_version,
             "process_state": self.process_state,
             "workorder_id": self.workorder.get("workorder_id") if self.workorder else None,
             "workorder_name": self.workorder.get("name") if self.workorder else None,
@@ -177,11 +276,15 @@ class KneaderController:
                 status["mixing_time_remaining"] = 0
 
         # Inject live_status into each item
+        live_statuses = []
         if self.workorder and self.workorder.get("steps"):
             for s_idx, step in enumerate(status["steps"]):
+                step_statuses = []
+                live_statuses.append(step_statuses)
+                scanned_set = self.scanned_items_by_step.get(s_idx, set())
+                all_scanned = self._step_fully_scanned(s_idx)
                 for item in step.get("items", []):
                     item_status = "WAITING"
-                    scanned_set = self.scanned_items_by_step.get(s_idx, set())
 
                     # === NEW LOGIC: Handle ABORTED state first ===
                     if self.process_state == "ABORTED":
@@ -211,10 +314,6 @@ class KneaderController:
                             item_status = "READY_TO_LOAD"
                         elif self.process_state == "WAITING_FOR_ITEMS":
                             if item["item_id"] in scanned_set:
-                                all_scanned = all(
-                                    i["item_id"] in scanned_set
-                                    for i in self.workorder["steps"][s_idx]["items"]
-                                )
                                 item_status = "READY_TO_LOAD" if all_scanned else "SCANNED"
                             else:
                                 item_status = "WAITING"
@@ -234,8 +333,27 @@ class KneaderController:
                             item_status = "WAITING"
 
                     item["live_status"] = item_status
+                    step_statuses.append(item_status)
+
+        status["steps"] = self._freeze_steps(status["steps"], live_statuses)
+        return StatusSnapshot(status)
+
+    def _freeze_steps(self, steps: List[Dict[str, Any]], live_statuses: List[List[str]]) -> tuple:
+        """
+        Read-only copies of the steps, so a snapshot stays as it is while the workorder moves on.
+        Steps whose items' live_status did not change since the last snapshot reuse their old copy.
+        """
+        previous = self._frozen_steps
+        self._frozen_steps = []
+        for s_idx, step in enumerate(steps):
+            step_statuses = live_statuses[s_idx] if s_idx < len(live_statuses) else None
+            old = previous[s_idx] if s_idx < len(previous) else None
+            if old is None or old[0] is not step or old[1] != step_statuses:
+                frozen = StatusSnapshot({**step, "items": tuple(StatusSnapshot(item) for item in step.get("items", []))})
+                old = (step, step_statuses, frozen)
+            self._frozen_steps.append(old)
+        return tuple(frozen for _, _, frozen in self._frozen_steps)
 
-        return status
     def _get_prescan_status(self, prescan_data: Dict[str, Any]) -> Dict[str, Any]:
         status_by_stage = {}
 
@@ -272,8 +390,7 @@ class KneaderController:
             await self.logger.log("WARNING", "Gateway not connected, attempting to reconnect",
                                   data=self.get_full_status(), is_event=True)
             try:
-                await self.gateway.connect()
-                if self.gateway.is_connected:
+                if await self.gateway.wait_connected():
                     await self.logger.log("INFO", "Gateway reconnected successfully",
                                           data=self.get_full_status(), is_event=True)
                 else:
@@ -410,7 +527,7 @@ class KneaderController:
             scanned_set = self.scanned_items_by_step.setdefault(target_step_index, set())
 
             if item_code not in scanned_set:
-                scanned_set.add(item_code)
+                self._record_scan(target_step_index, item_code)
 
                 if target_step_index == self.current_step_index:
                     scanned_item_ids.add(item_code)
@@ -446,6 +563,36 @@ class KneaderController:
         if future:
             future.set_result(scan_response)
 
+    async def _schedule_mix_end(self, duration: float):
+        """Has the gateway stop the motor and open the lid when mixing time is up, independent of our loop."""
+        await self._cancel_mix_end()
+        response = await self.gateway.schedule_writes([("wr_motor_control_kn1", 0), ("wr_lid_status_kn1", 0)],
+                                                      delay_sec=duration, schedule_id="kn1_mix_end")
+        if response and response.get("status") == "ok":
+            self._mix_end_schedule_id = response["schedule_id"]
+        else:
+            await self.logger.log("WARNING", f"Gateway did not accept the mix end schedule: {response}",
+                                  data=self.get_full_status(), is_event=False)
+
+    async def _cancel_mix_end(self):
+        schedule_id, self._mix_end_schedule_id = self._mix_end_schedule_id, None
+        if schedule_id:
+            await self.gateway.cancel_schedule(schedule_id)
+
+    async def _finish_mix_end(self):
+        """Reconciles with the gateway's scheduled stop; writes motor off + lid open itself if that did not happen."""
+        schedule_id, self._mix_end_schedule_id = self._mix_end_schedule_id, None
+        if schedule_id:
+            deadline = time.time() + 5.0
+            while time.time() < deadline:
+                state = (await self.gateway.get_schedule(schedule_id) or {}).get("state")
+                if state == "done":
+                    return
+                if state not in ("pending", "running"):
+                    break
+                await asyncio.sleep(0.2)
+        await self.gateway.write_many([("wr_motor_control_kn1", 0), ("wr_lid_status_kn1", 0)])
+
     async def _execute_mixing_process(self, step_index: int) -> bool:
         lid_timeout = getattr(config, 'LID_CLOSE_TIMEOUT_SEC', 30.0)
 
@@ -468,6 +615,7 @@ class KneaderController:
 
             await self.logger.log("INFO", f"Mixing started for {mix_duration} seconds",
                                   data=self.get_full_status(), is_event=True)
+            await self._schedule_mix_end(mix_duration)
 
             # Mixing countdown loop
             mix_end_time = self.mixing_start_timestamp + mix_duration
@@ -482,6 +630,7 @@ class KneaderController:
                     self.mixing_start_timestamp = time.time()
                     mix_end_time = self.mixing_start_timestamp + mix_duration
                     self._resumed_from_abort = False  # Reset the flag now that we've used it
+                    await self._schedule_mix_end(mix_duration)
                     await self.logger.log("INFO", f"Mixing resumed. Remaining duration: {int(mix_duration)}s",
                                           data=self.get_full_status(), is_event=True)
 
@@ -499,17 +648,14 @@ class KneaderController:
             # === Step completed ===
             self.mixing_timer_started = False
             self.remaining_mix_time = 0
-            await self.gateway.send_command({"action": "write", "tag_name": "wr_motor_control_kn1", "value": 0})
-            await self.gateway.send_command({"action": "write", "tag_name": "wr_lid_status_kn1", "value": 0})
+            await self._finish_mix_end()
             self.motor_running = False
 
-            lid_open_start = time.time()
-            while not self.lid_open:
-                if time.time() - lid_open_start > lid_timeout:
-                    await self.logger.log("WARNING", "Lid failed to open within timeout, but continuing",
-                                          data=self.get_full_status(), is_event=True)
-                    break
-                await asyncio.sleep(0.2)
+            try:
+                await self.gateway.wait_for("rd_lid_status_kn1", lambda closed: not closed, lid_timeout)
+            except asyncio.TimeoutError:
+                await self.logger.log("WARNING", "Lid failed to open within timeout, but continuing",
+                                      data=self.get_full_status(), is_event=True)
 
             #  Mark only THIS step’s items as DONE
             for item in self.workorder["steps"][step_index]["items"]:
@@ -518,11 +664,8 @@ class KneaderController:
             # Advance to next step or complete
             if self.current_step_index < len(self.workorder["steps"]) - 1:
                 self.current_step_index += 1
-                next_step = self.workorder["steps"][self.current_step_index]
-                scanned_set = self.scanned_items_by_step.get(self.current_step_index, set())
-                all_scanned = all(i["item_id"] in scanned_set for i in next_step["items"])
 
-                if all_scanned:
+                if self._step_fully_scanned(self.current_step_index):
                     self.process_state = "READY_TO_LOAD"
                     await self.logger.log(
                         "INFO",
@@ -553,11 +696,17 @@ class KneaderController:
         except Exception as e:
             await self.logger.log("ERROR", f"Error in mixing process: {e}", data=self.get_full_status(), is_event=True)
             try:
-                await self.gateway.send_command({"action": "write", "tag_name": "wr_motor_control_kn1", "value": 0})
-                await self.gateway.send_command({"action": "write", "tag_name": "wr_lid_status_kn1", "value": 0})
+                await self.gateway.write_many([("wr_motor_control_kn1", 0), ("wr_lid_status_kn1", 0)])
             except:
                 pass
             raise
+        finally:
+            # Also on cancellation (reset/cancel): a leftover kn1_mix_end must not stop the next workorder
+            try:
+                await self._cancel_mix_end()
+            except Exception as e:
+                await self.logger.log("WARNING", f"Could not cancel the mix end schedule: {e}",
+                                      data=self.get_full_status(), is_event=True)
     async def _process_workorder(self, initial_barcode: Optional[str] = None):
         try:
             await self.logger.log("INFO", f"Starting workorder: {self.workorder.get('name')}",
@@ -620,17 +769,15 @@ class KneaderController:
         last_aborted_log = 0
         while True:
             try:
-                if not self.gateway.is_connected:
-                    await self.gateway.connect()
-
-                if self.gateway.is_connected:
-                    # Read lid status
-                    res_lid = await self.gateway.send_command({"action": "read", "tag_name": "rd_lid_status_kn1"})
+                if await self.gateway.wait_connected():
+                    # Read lid + motor status in one round trip (served from the gateway's event-fed tag cache when fresh)
+                    results = await self.gateway.read_many(["rd_lid_status_kn1", "rd_motor_status_kn1"],
+                                                           max_age_ms=1000)
+                    res_lid = results.get("rd_lid_status_kn1")
                     if res_lid and "value" in res_lid:
                         self.lid_open = res_lid["value"] is False
 
-                    # Read motor status
-                    res_motor = await self.gateway.send_command({"action": "read", "tag_name": "rd_motor_status_kn1"})
+                    res_motor = results.get("rd_motor_status_kn1")
                     if res_motor and "value" in res_motor:
                         self.motor_running = res_motor["value"]
 
@@ -657,9 +804,9 @@ class KneaderController:
     async def _handle_abort_command(self):
         if self.process_state in ("MIXING", "WAITING_FOR_ITEMS","READY_TO_LOAD"):
             try:
-                # Always stop motor and open lid (safe for both states)
-                await self.gateway.send_command({"action": "write", "tag_name": "wr_motor_control_kn1", "value": 0})
-                await self.gateway.send_command({"action": "write", "tag_name": "wr_lid_status_kn1", "value": 0})
+                # Always stop motor and open lid (safe for both states); resume schedules a new mix end
+                await self._cancel_mix_end()
+                await self.gateway.write_many([("wr_motor_control_kn1", 0), ("wr_lid_status_kn1", 0)])
 
                 if self.process_state == "MIXING":
                     # The 'while' loop in _execute_mixing_process keeps self.remaining_mix_time
@@ -718,23 +865,21 @@ class KneaderController:
 
                 # Wait for lid to close
                 lid_timeout = getattr(config, 'LID_CLOSE_TIMEOUT_SEC', 30.0)
-                lid_close_start = time.time()
-                while self.lid_open:
-                    if time.time() - lid_close_start > lid_timeout:
-                        raise ValueError("Lid failed to close within timeout")
-                    await asyncio.sleep(0.5)
+                try:
+                    await self.gateway.wait_for("rd_lid_status_kn1", bool, lid_timeout)
+                except asyncio.TimeoutError:
+                    raise ValueError("Lid failed to close within timeout")
 
                 # Start motor
                 await self.gateway.send_command({"action": "write", "tag_name": "wr_motor_control_kn1", "value": 1})
 
                 # Wait for motor to start
                 motor_timeout = getattr(config, 'MOTOR_START_TIMEOUT_SEC', 15.0)
-                motor_start_ts = time.time()
-                while not self.motor_running:
-                    if time.time() - motor_start_ts > motor_timeout:
-                        self.motor_start_failed_alert = True
-                        raise ValueError("Motor failed to start")
-                    await asyncio.sleep(0.5)
+                try:
+                    await self.gateway.wait_for("rd_motor_status_kn1", bool, motor_timeout)
+                except asyncio.TimeoutError:
+                    self.motor_start_failed_alert = True
+                    raise ValueError("Motor failed to start")
 
                 # Update state and resume mixing
                 self.process_state = "MIXING"
@@ -768,8 +913,8 @@ class KneaderController:
         try:
             # Always try to stop hardware regardless of state
             try:
-                await self.gateway.send_command({"action": "write", "tag_name": "wr_motor_control_kn1", "value": 0})
-                await self.gateway.send_command({"action": "write", "tag_name": "wr_lid_status_kn1", "value": 0})
+                await self._cancel_mix_end()
+                await self.gateway.write_many([("wr_motor_control_kn1", 0), ("wr_lid_status_kn1", 0)])
                 print("Hardware stopped: motor=0, lid=0")
             except Exception as e:
                 print(f"Hardware stop warning: {e}")
@@ -866,6 +1011,7 @@ class KneaderController:
         # Mirror ERP state locally (UI only)
         self._prescan_data["scanned_items"].add(item_code)
         self._prescan_data["all_items"][item_code]["status"] = "SCANNED"
+        self._touch_status()
 
         prescan_status = self._get_prescan_status(self._prescan_data)
 
@@ -1013,6 +1159,7 @@ class KneaderController:
                 return await self._handle_complete_abort_command()
             elif command == "cancel":
                 # mimic your existing cancel flow
+                await self._cancel_mix_end()
                 self._reset_internal_state()
                 self.workorder = None
                 self.process_state = "IDLE"
@@ -1147,6 +1294,7 @@ class KneaderController:
 
             # Ensure scanned_items is an empty set
             self._prescan_data["scanned_items"] = set()
+            self._touch_status()
 
             await self.logger.log("INFO", "Workorder loaded and normalized", data=self.get_full_status(), is_event=True)
             return self.get_full_status()
@@ -1187,8 +1335,7 @@ class KneaderController:
             allowed = True
             target_step = self.workorder["steps"][current_step]
         elif self.process_state == "MIXING" and next_step < len(self.workorder["steps"]):
-            step_items = {i["item_id"] for i in self.workorder["steps"][next_step]["items"]}
-            if item_id in step_items:
+            if next_step in self._workorder_index().get(item_id, ()):
                 allowed = True
                 target_step = self.workorder["steps"][next_step]
 
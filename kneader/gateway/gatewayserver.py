@@ -2,9 +2,26 @@ import asyncio
 import json
 import logging
 import configparser
+import hashlib
+import heapq
+import itertools
+import multiprocessing
+import operator
+import marshal
 import os
-from collections import defaultdict, deque
-from typing import Dict, Any, Optional, Set, List, Tuple
+import random
+import re
+import sys
+import time
+import zlib
+from collections import defaultdict, OrderedDict, deque
+from types import MappingProxyType
+from typing import Dict, Any, Optional, Set, List, Tuple, Mapping, NamedTuple, Callable
+
+# The wire codecs are shared with the controller client and the simulator
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.wire_codec import JSON_CODEC, PREFERRED_CODECS, FrameProtocol, parse_codec_list, select_codec  # noqa: E402
+from utils.rtu_config import event_report, is_state_based  # noqa: E402
 
 # --- Basic Logging Setup ---
 logging.basicConfig(
@@ -13,6 +30,381 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Modbus block-read planning: registers at most MAX_GAP apart are merged into one read, and a block
+# never exceeds MAX_BLOCK_LENGTH registers (Modbus allows 125 per request). The default gap of 0 merges
+# only contiguous registers: reading unconfigured ones in between makes many slaves fail the whole block.
+# Per slave: modbus_max_register_gap = <default>, <slave_id>:<gap>, ...
+MODBUS_MAX_REGISTER_GAP = 0
+MODBUS_MAX_BLOCK_LENGTH = 125
+
+# Per-subscriber event queues. Policies when a queue is full:
+#   latest_per_tag - replace the tag's newest pending event (drop the oldest event if the tag has none)
+#   drop_oldest    - drop the oldest pending event
+#   disconnect     - close the slow client
+SUBSCRIBER_QUEUE_SIZE = 256
+SUBSCRIBER_OVERFLOW_POLICY = "latest_per_tag"
+
+# Gateway-side polling of tags whose event_report is "Periodic" (or "Time Based"); set_time is the
+# interval in seconds. Tags due within POLL_BATCH_WINDOW_SEC of each other go out as one batch per MC.
+PERIODIC_EVENT_REPORTS = ("periodic", "time based")
+POLL_MIN_INTERVAL_SEC = 0.1
+POLL_BATCH_WINDOW_SEC = 0.05
+
+# Send lanes per microcontroller (lower goes first). Tags with "priority": "safety" use the safety lane,
+# which also bypasses the in-flight window, so a motor stop waits behind at most MC_MAX_IN_FLIGHT
+# commands already on the wire instead of a whole backlog of reads and polls.
+PRIORITY_SAFETY, PRIORITY_WRITE, PRIORITY_READ, PRIORITY_POLL = 0, 1, 2, 3
+MC_MAX_IN_FLIGHT = 4
+
+# Reconnect with exponential backoff and jitter; a heartbeat detects half-open sockets.
+RECONNECT_INITIAL_DELAY_SEC = 0.5
+RECONNECT_MAX_DELAY_SEC = 10.0
+CONNECT_TIMEOUT_SEC = 3.0
+HEARTBEAT_INTERVAL_SEC = 2.0
+
+# Request timeouts derived from observed round-trip times: RTT_TIMEOUT_MULTIPLIER x p99, clamped,
+# plus p50 for every command queued or in flight ahead of the request. Until RTT_MIN_SAMPLES
+# responses have been seen, the maximum is used.
+REQUEST_TIMEOUT_MIN_SEC = 0.5
+REQUEST_TIMEOUT_MAX_SEC = 5.0
+RTT_TIMEOUT_MULTIPLIER = 3.0
+RTT_MIN_SAMPLES = 20
+RTT_WINDOW = 256
+
+# Forwarded events get a sequence number and stay replayable (subscribe_events with since_seq) for the
+# last EVENT_JOURNAL_SIZE events; with a journal path they are also appended to disk and survive restarts.
+# Each gateway process journals under a fresh random epoch, sent in the subscribe reply and in every event:
+# a client replaying from another epoch gets replay_complete=False (tags may have changed unseen meanwhile).
+EVENT_JOURNAL_SIZE = 1024
+EVENT_JOURNAL_MAX_BYTES = 1 << 20
+
+# Interlock rules from the [gateway_interlocks] section of config.ini, one per line:
+#   <name> = <tag> <op> <value> -> <tag> = <value>[, <tag> = <value> ...]
+# evaluated on every interrupt of the trigger tag; the writes go out in the safety lane.
+INTERLOCK_OPERATORS = {"==": operator.eq, "!=": operator.ne, ">=": operator.ge, "<=": operator.le,
+                       ">": operator.gt, "<": operator.lt}
+ORDERING_OPERATORS = (">=", "<=", ">", "<")
+INTERLOCK_CONDITION = re.compile(r"\s*(\w+)\s*(==|!=|>=|<=|>|<)\s*(\S.*?)\s*")
+
+# Scheduled writes (schedule_writes action) go out one at a time in the order given, each only after
+# the previous one succeeded ("motor off" lands before "lid open"). A failing write is retried every
+# SCHEDULE_RETRY_INTERVAL_SEC for up to SCHEDULE_RETRY_WINDOW_SEC, e.g. across an MC reconnect; the
+# writes after it are not sent until it succeeds, and not at all if it never does.
+# The outcome of the last SCHEDULE_HISTORY finished schedules stays queryable with get_schedule.
+SCHEDULE_RETRY_INTERVAL_SEC = 1.0
+SCHEDULE_RETRY_WINDOW_SEC = 30.0
+SCHEDULE_HISTORY = 64
+
+# The RTU config file is checked for changes every CONFIG_WATCH_INTERVAL_SEC (0 disables hot reload).
+# With a config_cache_path, the parsed config is also kept there (marshal, keyed by the file's SHA-256):
+# the file is still read and hashed on every start, the cache only saves the JSON parse.
+CONFIG_WATCH_INTERVAL_SEC = 2.0
+
+# Gateway-side interrupt filtering on top of the MC's own debounce: an interrupt is forwarded once its tag
+# has kept the value for INTERRUPT_SETTLE_MS (per tag: "debounce_ms" in the RTU config, 0 = at once), and
+# only if the settled value differs from the last one reported. Interlocks and the tag cache see every
+# interrupt immediately; only what goes to subscribers is filtered.
+INTERRUPT_SETTLE_MS = 50
+
+# Sharded mode (shard_workers > 1): MCs are spread over that many worker processes by shard_of(ip, port),
+# each a GatewayManager listening on 127.0.0.1:<shard_base_port + index>. The public port is served by a
+# GatewayRouter that forwards commands by tag and merges the workers' event streams into one journal.
+SHARD_REQUEST_TIMEOUT_SEC = 10.0
+SHARD_WORKER_RESTART_DELAY_SEC = 1.0
+
+# Request latency histogram bucket bounds (ms), also used by the optional HTTP metrics endpoint
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+# --- Metrics ---
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram; cheap enough to update on every request."""
+
+    def __init__(self, bounds_ms: Tuple[float, ...] = LATENCY_BUCKETS_MS):
+        self.bounds_ms = bounds_ms
+        self.counts = [0] * (len(bounds_ms) + 1)  # The last bucket is +Inf
+        self.count, self.sum_ms = 0, 0.0
+
+    def observe(self, seconds: float):
+        ms = seconds * 1000.0
+        i = 0
+        while i < len(self.bounds_ms) and ms > self.bounds_ms[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum_ms += ms
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Cumulative bucket counts keyed by upper bound, Prometheus style."""
+        buckets, running = {}, 0
+        for bound, n in zip(list(self.bounds_ms) + ["+Inf"], self.counts):
+            running += n
+            buckets[str(bound)] = running
+        return {"count": self.count, "sum_ms": round(self.sum_ms, 3), "buckets": buckets}
+
+
+def format_metrics_text(stats: Dict[str, Any]) -> str:
+    """Renders the stats action's result in the Prometheus text exposition format."""
+    lines = [f"kneader_gateway_event_queue_depth {stats['event_queue_depth']}"]
+    for name, count in stats.get("interrupts", {}).items():
+        lines.append(f"kneader_gateway_interrupts_{name}_total {count}")
+    for tag, count in stats.get("suppressed_interrupts", {}).items():
+        lines.append(f'kneader_gateway_interrupts_suppressed_total{{tag="{tag}"}} {count}')
+    for mc, mc_stats in stats["microcontrollers"].items():
+        label = f'mc="{mc}"'
+        lines.append(f"kneader_mc_connected{{{label}}} {int(mc_stats['connected'])}")
+        for name in ("requests", "timeouts", "errors", "uncorrelated", "reconnects"):
+            lines.append(f"kneader_mc_{name}_total{{{label}}} {mc_stats[name]}")
+        for name in ("in_flight", "queued"):
+            lines.append(f"kneader_mc_{name}{{{label}}} {mc_stats[name]}")
+        latency = mc_stats["latency_ms"]
+        for bound, n in latency["buckets"].items():
+            lines.append(f'kneader_mc_request_latency_ms_bucket{{{label},le="{bound}"}} {n}')
+        lines.append(f"kneader_mc_request_latency_ms_sum{{{label}}} {latency['sum_ms']}")
+        lines.append(f"kneader_mc_request_latency_ms_count{{{label}}} {latency['count']}")
+    for sub in stats.get("subscribers", []):
+        label = f'peer="{sub["peer"]}"'
+        lines.append(f"kneader_subscriber_queue_depth{{{label}}} {sub['queue_depth']}")
+        lines.append(f"kneader_subscriber_sent_total{{{label}}} {sub['sent']}")
+        lines.append(f"kneader_subscriber_dropped_total{{{label}}} {sub['dropped']}")
+        lines.append(f"kneader_subscriber_lag_ms{{{label}}} {sub['last_lag_ms']:.3f}")
+        lines.append(f"kneader_subscriber_max_lag_ms{{{label}}} {sub['max_lag_ms']:.3f}")
+    return "\n".join(lines) + "\n"
+
+
+# --- Event Journal ---
+
+class EventJournal:
+    """
+    Sequence numbers and a bounded replay buffer for forwarded events. With a path, every event is also
+    appended to a JSON-lines file (rotated to <path>.1 past max_bytes) that is read back on startup,
+    so sequence numbers keep increasing across gateway restarts.
+    """
+
+    def __init__(self, size: int = EVENT_JOURNAL_SIZE, path: Optional[str] = None,
+                 max_bytes: int = EVENT_JOURNAL_MAX_BYTES):
+        self.events: deque = deque(maxlen=size)
+        self.last_seq = 0
+        self.epoch = os.urandom(8).hex()
+        self.path, self.max_bytes = path, max_bytes
+        self._file = None
+        if path:
+            for event in self._read_disk():
+                self.events.append(event)
+                self.last_seq = event["seq"]
+            self._file = open(path, "a", encoding="utf-8")
+            logger.info(f"Event journal {path} restored up to seq {self.last_seq}")
+
+    def _read_disk(self):
+        for path in (self.path + ".1", self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue  # Torn last line from a crash
+                    if event.get("seq", 0) > self.last_seq:
+                        yield event
+
+    def append(self, event: Dict[str, Any]) -> int:
+        self.last_seq += 1
+        event["seq"], event["epoch"] = self.last_seq, self.epoch
+        self.events.append(event)
+        if self._file:
+            self._file.write(json.dumps(event) + "\n")
+            self._file.flush()
+            if self._file.tell() > self.max_bytes:
+                self._file.close()
+                os.replace(self.path, self.path + ".1")
+                self._file = open(self.path, "a", encoding="utf-8")
+        return self.last_seq
+
+    def new_epoch(self):
+        """Starts a new epoch, so every client replaying from before now resyncs (e.g. a shard worker restarted)."""
+        self.epoch = os.urandom(8).hex()
+
+    def since(self, seq: int, epoch: Optional[str] = None) -> Tuple[List[Dict[str, Any]], bool]:
+        """
+        Events after `seq`, oldest first, and whether that is all of them. Incomplete means events were
+        already dropped, the journal restarted behind the client (seq ahead of last_seq), or `seq` is
+        from another epoch than the current one.
+        """
+        if epoch is not None and epoch != self.epoch:
+            return [event for event in self.events if event.get("epoch") == self.epoch], False
+        if seq == self.last_seq:
+            return [], True
+        if seq > self.last_seq:
+            return list(self.events), False
+        oldest = self.events[0]["seq"] if self.events else self.last_seq + 1
+        if seq + 1 >= oldest:
+            # Sequence numbers in the ring are contiguous, so the start is found by arithmetic
+            return list(itertools.islice(self.events, seq + 1 - oldest, None)), True
+        if self.path:
+            self.last_seq, last_seq = seq, self.last_seq  # _read_disk skips everything up to last_seq
+            try:
+                events = list(self._read_disk())
+            finally:
+                self.last_seq = last_seq
+            if events and events[0]["seq"] == seq + 1:
+                return events, True
+        return list(self.events), False
+
+
+# --- Interlocks ---
+
+class Interlock(NamedTuple):
+    name: str
+    tag_name: str
+    compare: Callable[[Any, Any], bool]
+    value: Any
+    writes: Tuple[Tuple[str, Any], ...]
+
+
+def _parse_interlock_value(text: str) -> Any:
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text.strip()
+
+
+def parse_interlock(name: str, spec: str) -> Interlock:
+    """Parses one rule, e.g. "rd_lid_status_kn1 == 0 -> wr_motor_control_kn1 = 0"."""
+    condition, arrow, actions = spec.partition("->")
+    match = INTERLOCK_CONDITION.fullmatch(condition)
+    if not arrow or not match:
+        raise ValueError(f"Interlock '{name}': expected '<tag> <op> <value> -> <tag> = <value>', got '{spec}'")
+    writes = []
+    for action in actions.split(","):
+        tag_name, equals, value = action.partition("=")
+        if not equals or not tag_name.strip() or not value.strip():
+            raise ValueError(f"Interlock '{name}': invalid action '{action.strip()}'")
+        writes.append((tag_name.strip(), _parse_interlock_value(value)))
+    tag_name, op, value = match.groups()
+    value = _parse_interlock_value(value)
+    if op in ORDERING_OPERATORS and (isinstance(value, bool) or not isinstance(value, (int, float))):
+        raise ValueError(f"Interlock '{name}': '{op}' needs a numeric value, got {value!r}")
+    return Interlock(name, tag_name, INTERLOCK_OPERATORS[op], value, tuple(writes))
+
+
+# --- Sharding ---
+
+def shard_of(host: str, port: int, shard_count: int) -> int:
+    """Worker index of an MC; stable across restarts and config reloads."""
+    return zlib.crc32(f"{host}:{port}".encode()) % shard_count
+
+
+# --- Modbus Read Planner ---
+
+def is_modbus_register_tag(tag_config: Dict) -> bool:
+    """True for tags that are read through modbus_read (not an ESP32 pin or a PCF8574 pin)."""
+    is_pcf = "pcf_addr" in tag_config and "pcf_pin" in tag_config
+    return not is_pcf and "Pin" not in tag_config.get("function_code", "")
+
+
+def parse_register_gaps(spec: str) -> Tuple[int, Dict[str, int]]:
+    """Parses modbus_max_register_gap, e.g. "0, 3:4" -> (0, {"3": 4}): a default plus per-slave gaps."""
+    default, per_slave = MODBUS_MAX_REGISTER_GAP, {}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        slave_id, colon, gap = part.rpartition(":")
+        if colon:
+            per_slave[slave_id.strip()] = int(gap)
+        else:
+            default = int(gap)
+    return default, per_slave
+
+
+def plan_modbus_block_reads(tag_configs: List[Dict], max_gap: int = MODBUS_MAX_REGISTER_GAP,
+                            max_block_length: int = MODBUS_MAX_BLOCK_LENGTH,
+                            slave_gaps: Optional[Mapping[str, int]] = None) -> List[Dict[str, Any]]:
+    """
+    Merges reads of adjacent or nearby registers on the same slave_id into block reads.
+    Each block is {"slave_id", "register", "length", "tags": [(tag_name, offset, length), ...]},
+    where offset/length locate each tag's registers inside the block result.
+    slave_gaps overrides max_gap per slave_id (keys as strings).
+    """
+    by_slave = defaultdict(list)
+    for tag in tag_configs:
+        by_slave[tag["slave_id"]].append(tag)
+
+    blocks = []
+    for slave_id, tags in by_slave.items():
+        tags.sort(key=lambda t: int(t["start_add"]))
+        slave_gap = (slave_gaps or {}).get(str(slave_id), max_gap)
+        block = None
+        for tag in tags:
+            start, length = int(tag["start_add"]), int(tag.get("length", 1) or 1)
+            end = start + length
+            if block is not None:
+                block_end = block["register"] + block["length"]
+                new_length = max(block_end, end) - block["register"]
+                if start - block_end <= slave_gap and new_length <= max_block_length:
+                    block["length"] = new_length
+                    block["tags"].append((tag["tag_name"], start - block["register"], length))
+                    continue
+            block = {"slave_id": slave_id, "register": start, "length": length,
+                     "tags": [(tag["tag_name"], 0, length)]}
+            blocks.append(block)
+    return blocks
+
+
+def split_modbus_block_result(block: Dict[str, Any], response: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Splits a block read response back into one read response per tag."""
+    values = response.get("values")
+    results = {}
+    for tag_name, offset, length in block["tags"]:
+        if response.get("status") != "ok" or not isinstance(values, list) or offset + length > len(values):
+            results[tag_name] = {"status": "error",
+                                 "message": response.get("message", "Invalid block read response from microcontroller")}
+            continue
+        value = values[offset] if length == 1 else values[offset:offset + length]
+        results[tag_name] = {"status": "ok", "slave_id": block["slave_id"], "register": block["register"] + offset,
+                             "value": value}
+    return results
+
+
+# --- Compiled Tag Routes ---
+
+class TagRoute(NamedTuple):
+    """Immutable routing record compiled once per tag in load_config; routing copies a skeleton and sets the value."""
+    tag_name: str
+    mc_client: 'MicrocontrollerClient'
+    read_command: Mapping[str, Any]
+    write_command: Mapping[str, Any]
+    read_key: Tuple
+    write_key: Tuple
+    collapse_writes: bool
+    write_priority: int
+
+
+def compile_tag_route(tag_config: Dict, mc_client: 'MicrocontrollerClient') -> TagRoute:
+    """Pre-builds the ESP32 read/write command skeletons and request keys for one tag."""
+    slave_id, start_add = tag_config["slave_id"], tag_config.get("start_add")
+    mc_key = (mc_client.host, mc_client.port)
+
+    if "pcf_addr" in tag_config and "pcf_pin" in tag_config:
+        pcf_addr_str, pcf_pin = tag_config["pcf_addr"], tag_config["pcf_pin"]
+        pcf_addr = int(pcf_addr_str, 16)
+        read_command = {"cmd": "pcf_read", "slave_id": slave_id, "addr": pcf_addr, "pin": pcf_pin}
+        write_command = {"cmd": "pcf_write", "slave_id": slave_id, "addr": pcf_addr, "pin": pcf_pin}
+        read_key = ("pcf_read", *mc_key, slave_id, pcf_addr_str, pcf_pin)
+        write_key = ("pcf_write", *mc_key, slave_id, pcf_addr_str, pcf_pin)
+    else:
+        function_code = tag_config["function_code"]
+        read_cmd, read_field = ("read", "pin") if function_code == "Read Pin" else ("modbus_read", "register")
+        write_cmd, write_field = ("write", "pin") if function_code == "Write Pin" else ("modbus_write", "register")
+        read_command = {"cmd": read_cmd, "slave_id": slave_id, read_field: start_add}
+        write_command = {"cmd": write_cmd, "slave_id": slave_id, write_field: start_add}
+        read_key = (read_cmd, *mc_key, slave_id, start_add)
+        write_key = (write_cmd, *mc_key, slave_id, start_add)
+
+    return TagRoute(tag_config["tag_name"], mc_client, MappingProxyType(read_command),
+                    MappingProxyType(write_command), read_key, write_key,
+                    bool(tag_config.get("collapse_writes", False)),
+                    PRIORITY_SAFETY if str(tag_config.get("priority", "")).lower() == "safety" else PRIORITY_WRITE)
+
 
 # --- Main Gateway Orchestrator ---
 
@@ -21,43 +413,231 @@ class GatewayManager:
     Central class to manage all microcontroller connections and the server for top-level clients.
     """
 
-    def __init__(self, config_path: str):
+    def __init__(self, config_path: str, options: Optional[Dict[str, Any]] = None,
+                 interlocks: Optional[Dict[str, str]] = None):
         self.config_path = config_path
+        # Tunables from the [gateway_server] section of config.ini (values may be strings)
+        self.options = options or {}
+        # Rule specs from [gateway_interlocks]; compiled per trigger tag by load_config
+        self.interlock_specs = interlocks or {}
+        self.interlocks: Dict[str, List[Interlock]] = defaultdict(list)
+        self.interlock_stats = {"fired": 0, "failed": 0}
+        # schedule_id -> {"writes", "due_at" (epoch seconds), "state", "results", "handle"}
+        self.schedules: Dict[str, Dict[str, Any]] = {}
+        self._schedule_ids = itertools.count(1)
+        self._finished_schedules: deque = deque()
         self.mc_clients: Dict[Tuple[str, int], MicrocontrollerClient] = {}
         self.tag_map: Dict[str, Dict[str, Any]] = {}
         self.tag_to_mc_map: Dict[str, MicrocontrollerClient] = {}
+        self.tag_routes: Dict[str, TagRoute] = {}
         self.interrupt_source_to_tag_map: Dict[Tuple, str] = {}
+        self.event_fed_tags: Set[str] = set()
+        # Shard worker of a sharded gateway: only the MCs with shard_of(...) == shard_index are handled here
+        self.shard_index = int(self.options.get("shard_index", 0))
+        self.shard_count = int(self.options.get("shard_count", 1))
+        self.config_digest: Optional[str] = None
+        # Connection and poll scheduler task per MC key, so hot reload can stop or restart them
+        self._mc_tasks: Dict[Tuple[str, int], asyncio.Task] = {}
+        self._poll_tasks: Dict[Tuple[str, int], asyncio.Task] = {}
         self.event_queue = asyncio.Queue()
-        # NEW: Dictionary to hold queues of Futures for pending requests
-        self.pending_requests: Dict[Tuple, deque] = defaultdict(deque)
+        self.journal = EventJournal(int(self.options.get("event_journal_size", EVENT_JOURNAL_SIZE)),
+                                    self.options.get("event_journal_path") or None,
+                                    int(self.options.get("event_journal_max_bytes", EVENT_JOURNAL_MAX_BYTES)))
+        # Every command sent to an MC carries a gateway-wide unique req_id that the MC echoes back;
+        # the futures waiting on them live in each MicrocontrollerClient.pending_requests.
+        self._req_ids = itertools.count(1)
+        # tag_name -> (value, monotonic timestamp). Fed by interrupts and by read/write responses.
+        self.tag_cache: Dict[str, Tuple[Any, float]] = {}
+        # tag_name -> last value published by the poll scheduler or forwarded for an interrupt (report-by-exception)
+        self.last_reported_values: Dict[str, Any] = {}
+        self.interrupt_settle_ms = float(self.options.get("interrupt_settle_ms", INTERRUPT_SETTLE_MS))
+        # tag_name -> (timer, interrupt) of the interrupt waiting to settle
+        self._settling: Dict[str, Tuple[asyncio.TimerHandle, Dict[str, Any]]] = {}
+        self.interrupt_stats = {"received": 0, "forwarded": 0, "bounces": 0, "duplicates": 0}
+        self.suppressed_interrupts: Dict[str, int] = defaultdict(int)
+        # Singleflight: read_key -> {"future", "command", "priority"} of the in-flight read shared by every
+        # concurrent identical read; dropped when a write to the tag is sent, so later reads see the write
+        self.in_flight_reads: Dict[Tuple, Dict[str, Any]] = {}
+        # tag_name -> {"value", "waiters"} for tags with collapse_writes (last write wins)
+        self.collapsed_writes: Dict[str, Dict[str, Any]] = {}
+        self.register_gap, self.slave_register_gaps = parse_register_gaps(
+            str(self.options.get("modbus_max_register_gap", MODBUS_MAX_REGISTER_GAP)))
+        # Binary codecs offered to MCs and accepted from clients, in order of preference
+        self.wire_codecs = parse_codec_list(self.options.get("wire_codecs", ",".join(PREFERRED_CODECS)))
 
     def load_config(self):
         """Parses the main JSON config to build the gateway's operational structure."""
         logger.info(f"Loading configuration from {self.config_path}")
-        with open(self.config_path, 'r') as f:
-            full_config = json.load(f)
+        full_config, self.config_digest = self._read_config()
+        self._apply_config(full_config)
+        logger.info(f"Configuration loaded. Found {len(self.mc_clients)} microcontrollers.")
 
+    def _read_config(self) -> Tuple[List[Dict], str]:
+        """
+        Returns the parsed RTU config and its SHA-256, from the parse cache (if configured) when the
+        file is unchanged. Raises OSError or ValueError if it cannot be read or is not a list of tags.
+        """
+        with open(self.config_path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        cache_path = self.options.get("config_cache_path", "")
+        if cache_path:
+            try:
+                with open(cache_path, 'rb') as f:
+                    cached_digest, full_config = marshal.load(f)
+                if cached_digest == digest:
+                    return full_config, digest
+            except (OSError, EOFError, ValueError, TypeError):
+                pass
+        full_config = json.loads(data)
+        if not isinstance(full_config, list) or not all(isinstance(tag, dict) for tag in full_config):
+            raise ValueError("the RTU config must be a JSON list of tag objects")
+        if cache_path:
+            try:
+                # Written aside and renamed, so shard workers reading the cache never see half a file
+                partial_path = f"{cache_path}.{os.getpid()}"
+                with open(partial_path, 'wb') as f:
+                    marshal.dump((digest, full_config), f)
+                os.replace(partial_path, cache_path)
+            except OSError as e:
+                logger.warning(f"Could not write config cache {cache_path}: {e}")
+        return full_config, digest
+
+    def _apply_config(self, full_config: List[Dict]) -> Tuple[List, List, List]:
+        """
+        Builds tag maps, routes and interlocks for `full_config` and swaps them in at once, reusing
+        the MicrocontrollerClient of every MC that is still configured. Raises before changing anything
+        if the config is invalid. Returns the (added, removed, changed) MC keys.
+        """
         tags_by_mc = defaultdict(list)
+        tag_map: Dict[str, Dict[str, Any]] = {}
+        interrupt_source_to_tag_map: Dict[Tuple, str] = {}
+        other_shard_tags = set()
         for tag in full_config:
-            self.tag_map[tag['tag_name']] = tag
             mc_host = tag.get("micro_controller_ip", "0.0.0.0")
             mc_port = int(tag.get("micro_controller_port", 8888))
+            if self.shard_count > 1 and shard_of(mc_host, mc_port, self.shard_count) != self.shard_index:
+                other_shard_tags.add(tag['tag_name'])
+                continue
+            tag_map[tag['tag_name']] = tag
             tags_by_mc[(mc_host, mc_port)].append(tag)
 
-            if tag.get("event_report") == "state based":
+            if is_state_based(tag):
                 key = None
                 if "pcf_addr" in tag and "pcf_pin" in tag:
                     key = ("pcf8574", tag["pcf_addr"].lower(), int(tag["pcf_pin"]))
                 elif "function_code" in tag and "Pin" in tag["function_code"]:
                     key = ("esp32", int(tag["start_add"]))
-                if key: self.interrupt_source_to_tag_map[key] = tag['tag_name']
-        logger.info(f"Interrupt sources mapped: {self.interrupt_source_to_tag_map}")  # Add this line here
-        for (host, port), tags in tags_by_mc.items():
-            client = MicrocontrollerClient(host, port, tags, self)  # Pass self (manager)
-            self.mc_clients[(host, port)] = client
-            for tag in tags: self.tag_to_mc_map[tag['tag_name']] = client
+                if key: interrupt_source_to_tag_map[key] = tag['tag_name']
+        logger.info(f"Interrupt sources mapped: {interrupt_source_to_tag_map}")
+        event_fed_tags = set(interrupt_source_to_tag_map.values())
 
-        logger.info(f"Configuration loaded. Found {len(self.mc_clients)} microcontrollers.")
+        added = [key for key in tags_by_mc if key not in self.mc_clients]
+        removed = [key for key in self.mc_clients if key not in tags_by_mc]
+        changed = [key for key in tags_by_mc if key in self.mc_clients and self.mc_clients[key].tags != tags_by_mc[key]]
+        mc_clients = {key: self.mc_clients[key] for key in tags_by_mc if key in self.mc_clients}
+        for host, port in added:
+            mc_clients[(host, port)] = MicrocontrollerClient(
+                host, port, tags_by_mc[(host, port)], self,  # Pass self (manager)
+                max_in_flight=int(self.options.get("mc_max_in_flight", MC_MAX_IN_FLIGHT)))
+
+        tag_to_mc_map: Dict[str, MicrocontrollerClient] = {}
+        tag_routes: Dict[str, TagRoute] = {}
+        for key, tags in tags_by_mc.items():
+            for tag in tags:
+                tag_to_mc_map[tag['tag_name']] = mc_clients[key]
+                tag_routes[tag['tag_name']] = compile_tag_route(tag, mc_clients[key])
+
+        interlocks: Dict[str, List[Interlock]] = defaultdict(list)
+        for name, spec in self.interlock_specs.items():
+            rule = parse_interlock(name, spec)
+            if rule.tag_name in other_shard_tags:
+                continue  # Evaluated by the shard worker that owns the trigger tag
+            elsewhere = [tag for tag, _ in rule.writes if tag in other_shard_tags]
+            if elsewhere:
+                raise ValueError(f"Interlock '{name}' writes to tags of another shard: {elsewhere}")
+            unknown = [tag for tag, _ in rule.writes if tag not in tag_routes]
+            if unknown:
+                raise ValueError(f"Interlock '{name}' writes to unknown tags: {unknown}")
+            if rule.tag_name not in event_fed_tags:
+                logger.warning(f"Interlock '{name}' will never fire: {rule.tag_name} is not a state based tag.")
+            interlocks[rule.tag_name].append(rule)
+        if self.interlock_specs:
+            logger.info(f"Interlocks loaded: {list(self.interlock_specs)}")
+
+        # Swap everything in without awaiting in between, so no request sees a half-built mapping
+        stale_tags = [name for name, tag in self.tag_map.items() if tag_map.get(name) != tag]
+        for key in changed:
+            mc_clients[key].tags = tags_by_mc[key]
+        self.mc_clients, self.tag_map, self.tag_to_mc_map, self.tag_routes = mc_clients, tag_map, tag_to_mc_map, tag_routes
+        self.interrupt_source_to_tag_map, self.event_fed_tags = interrupt_source_to_tag_map, event_fed_tags
+        self.interlocks = interlocks
+        for name in stale_tags:
+            self.tag_cache.pop(name, None)
+            self.last_reported_values.pop(name, None)
+        return added, removed, changed
+
+    async def reload_config(self) -> bool:
+        """
+        Re-reads the RTU config and applies the difference: new MCs are connected, dropped ones are
+        disconnected, and changed ones are re-subscribed or re-polled only where that is affected.
+        Untouched connections and subscribers are left alone. An invalid config is rejected as a whole.
+        """
+        try:
+            full_config, digest = self._read_config()
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not load {self.config_path}, keeping the current configuration: {e}")
+            return False
+        if digest == self.config_digest:
+            return False
+
+        old_pins = {key: mc.subscription_pins() for key, mc in self.mc_clients.items()}
+        old_periodic = {key: [tag for tag in mc.tags if self._poll_interval(tag)] for key, mc in self.mc_clients.items()}
+        try:
+            added, removed, changed = self._apply_config(full_config)
+        except Exception as e:
+            # Whatever is wrong with the new config, the running gateway keeps going on the old one
+            logger.error(f"Invalid configuration in {self.config_path}, keeping the current one: {e!r}")
+            return False
+        self.config_digest = digest
+
+        for key in removed:
+            for tasks in (self._mc_tasks, self._poll_tasks):
+                task = tasks.pop(key, None)
+                if task:
+                    task.cancel()
+        for key in added:
+            self._start_mc(key)
+        for key in changed:
+            mc = self.mc_clients[key]
+            if mc.is_connected and mc.subscription_pins() != old_pins[key]:
+                asyncio.ensure_future(mc._send_subscribe_command())
+            if [tag for tag in mc.tags if self._poll_interval(tag)] != old_periodic[key]:
+                task = self._poll_tasks.pop(key, None)
+                if task:
+                    task.cancel()
+                self._start_mc(key, poll_only=True)
+        logger.info(f"Configuration reloaded: {len(added)} MCs added, {len(removed)} removed, "
+                    f"{len(changed)} changed, {len(self.mc_clients) - len(added) - len(changed)} untouched.")
+        return True
+
+    async def _watch_config(self, interval: float):
+        """Reloads the RTU config whenever its size or modification time changes."""
+        signature = None
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                stat = os.stat(self.config_path)
+            except OSError:
+                continue
+            if signature is None:
+                signature = (stat.st_mtime_ns, stat.st_size)
+            elif (stat.st_mtime_ns, stat.st_size) != signature:
+                signature = (stat.st_mtime_ns, stat.st_size)
+                try:
+                    await self.reload_config()
+                except Exception as e:
+                    logger.exception(f"Config reload failed, the gateway keeps running: {e!r}")
 
     def get_tag_for_event(self, event: Dict) -> Optional[str]:
         source, key = event.get("source"), None
@@ -68,205 +648,858 @@ class GatewayManager:
         logger.debug(f"Event mapping: source={source}, key={key}, map={self.interrupt_source_to_tag_map}")
         return self.interrupt_source_to_tag_map.get(key)
 
+    def update_tag_cache(self, tag_name: str, value: Any):
+        self.tag_cache[tag_name] = (value, time.monotonic())
+
+    def invalidate_tag_cache(self, tags: List[Dict]):
+        """Drops cached values for the given tags, e.g. when their microcontroller disconnects."""
+        for tag in tags:
+            self.tag_cache.pop(tag['tag_name'], None)
+
+    def get_cached_value(self, tag_name: str, max_age_ms: float) -> Optional[Dict[str, Any]]:
+        """
+        Returns a read response from the cache, or None if the cached value is missing or older than
+        max_age_ms. An event-fed (state based) tag cached after its MC acknowledged the interrupt
+        subscription counts as confirmed by every later frame from that MC, since a change would have
+        arrived as an interrupt before it.
+        """
+        entry = self.tag_cache.get(tag_name)
+        if entry is None:
+            return None
+        value, updated_at = entry
+        if tag_name in self.event_fed_tags:
+            mc_client = self.tag_to_mc_map.get(tag_name)
+            if (mc_client and mc_client.is_connected and mc_client.subscribed_at is not None
+                    and updated_at >= mc_client.subscribed_at):
+                updated_at = max(updated_at, mc_client.last_received_at)
+        age_ms = (time.monotonic() - updated_at) * 1000.0
+        if age_ms > max_age_ms:
+            return None
+        return {"status": "ok", "tag_name": tag_name, "value": value, "source": "cache", "age_ms": int(age_ms)}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "event_queue_depth": self.event_queue.qsize(),
+            "event_seq": self.journal.last_seq,
+            "interlocks": dict(self.interlock_stats),
+            "interrupts": dict(self.interrupt_stats),
+            "suppressed_interrupts": dict(self.suppressed_interrupts),
+            "pending_schedules": sum(1 for s in self.schedules.values() if s["state"] == "pending"),
+            "microcontrollers": {f"{host}:{port}": mc.stats() for (host, port), mc in self.mc_clients.items()},
+        }
+
     async def start(self):
         self.load_config()
-        self.top_controller_server = GatewayTCPServer('0.0.0.0', 5020, self)
-        tasks = [mc.run() for mc in self.mc_clients.values()]
-        tasks.append(self.top_controller_server.start())
+        await self._serve()
+
+    async def _serve(self, *extra_tasks):
+        """Runs the MC clients, the top-level server and the optional config watcher and metrics endpoint."""
+        self.top_controller_server = GatewayTCPServer(
+            self.options.get("gateway_server_ip", "0.0.0.0"), int(self.options.get("gateway_server_port", 5020)), self,
+            queue_size=int(self.options.get("subscriber_queue_size", SUBSCRIBER_QUEUE_SIZE)),
+            overflow_policy=self.options.get("subscriber_overflow_policy", SUBSCRIBER_OVERFLOW_POLICY))
+        for key in self.mc_clients:
+            self._start_mc(key)
+        tasks = [self.top_controller_server.start(), *extra_tasks]
+        watch_interval = float(self.options.get("config_watch_interval", CONFIG_WATCH_INTERVAL_SEC))
+        if watch_interval > 0:
+            tasks.append(self._watch_config(watch_interval))
+        if self.options.get("metrics_http_port"):
+            tasks.append(self.top_controller_server.serve_metrics(
+                self.options.get("metrics_http_ip", "127.0.0.1"), int(self.options["metrics_http_port"])))
         await asyncio.gather(*tasks)
 
-    async def route_command_to_mc(self, command: Dict[str, Any]) -> Dict[str, Any]:
-        """Routes a command, creates a future for its response, and sends it."""
+    def _start_mc(self, key: Tuple[str, int], poll_only: bool = False):
+        """Starts the connection task of one MC and, if it has periodic tags, its poll scheduler."""
+        mc = self.mc_clients[key]
+        if not poll_only:
+            self._mc_tasks[key] = asyncio.create_task(mc.run())
+        periodic_tags = [tag for tag in mc.tags if self._poll_interval(tag)]
+        if periodic_tags:
+            self._poll_tasks[key] = asyncio.create_task(self._run_poll_scheduler(mc, periodic_tags))
+
+    @staticmethod
+    def _poll_interval(tag: Dict) -> Optional[float]:
+        """Poll interval in seconds for periodic tags, None for tags the gateway should not poll."""
+        if event_report(tag) not in PERIODIC_EVENT_REPORTS:
+            return None
+        interval = float(tag.get("set_time") or 0)
+        return max(interval, POLL_MIN_INTERVAL_SEC) if interval > 0 else None
+
+    async def _run_poll_scheduler(self, mc_client: 'MicrocontrollerClient', tags: List[Dict]):
+        """
+        Polls one microcontroller's periodic tags at their configured intervals. Tags that fall due
+        together are read as one read_many batch, and an event is published only when a value changes.
+        """
+        logger.info(f"Poll scheduler for {mc_client.host}:{mc_client.port} started for "
+                    f"{[tag['tag_name'] for tag in tags]}")
+        now = time.monotonic()
+        schedule = [(now, tag['tag_name'], self._poll_interval(tag)) for tag in tags]
+        heapq.heapify(schedule)
+        while True:
+            await asyncio.sleep(max(0.0, schedule[0][0] - time.monotonic()))
+            now = time.monotonic()
+            due = []
+            while schedule and schedule[0][0] <= now + POLL_BATCH_WINDOW_SEC:
+                due.append(heapq.heappop(schedule))
+            for due_at, tag_name, interval in due:
+                # Keep the polling phase, but never try to catch up on missed polls
+                heapq.heappush(schedule, (max(due_at + interval, now + interval / 2), tag_name, interval))
+
+            if not mc_client.is_connected:
+                continue
+            try:
+                response = await self.route_many_to_mcs({"action": "read_many", "tags": [d[1] for d in due]},
+                                                        priority=PRIORITY_POLL)
+            except Exception as e:
+                logger.error(f"Scheduled poll of {mc_client.host}:{mc_client.port} failed: {e}")
+                continue
+            for result in response.get("results", []):
+                if result.get("status") == "ok" and "value" in result:
+                    self._report_if_changed(result["tag_name"], result["value"])
+
+    def _report_if_changed(self, tag_name: str, value: Any):
+        """Publishes a poll_change event when the value moved by more than the tag's deadband."""
+        if tag_name in self.last_reported_values:
+            last = self.last_reported_values[tag_name]
+            deadband = float(self.tag_map.get(tag_name, {}).get("deadband", 0) or 0)
+            numeric = all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in (last, value))
+            if (abs(value - last) <= deadband) if numeric else (value == last):
+                return
+        self.last_reported_values[tag_name] = value
+        self.event_queue.put_nowait({"event": "poll_change", "source": "poll", "tag_name": tag_name,
+                                     "value": value, "timestamp": time.time()})
+
+    def report_interrupt(self, tag_name: str, payload: Dict[str, Any]):
+        """Forwards an interrupt once its tag's value has settled, unless that value was already reported."""
+        self.interrupt_stats["received"] += 1
+        settling = self._settling.pop(tag_name, None)
+        if settling:
+            settling[0].cancel()  # Superseded within the window: the contact is still bouncing
+            self._suppress_interrupt(tag_name, "bounces")
+        settle_ms = float(self.tag_map.get(tag_name, {}).get("debounce_ms", self.interrupt_settle_ms) or 0)
+        if settle_ms <= 0:
+            self._settle_interrupt(tag_name, payload)
+            return
+        handle = asyncio.get_running_loop().call_later(settle_ms / 1000.0, self._settle_interrupt, tag_name, payload)
+        self._settling[tag_name] = (handle, payload)
+
+    def _settle_interrupt(self, tag_name: str, payload: Dict[str, Any]):
+        self._settling.pop(tag_name, None)
+        value = payload.get("value")
+        if tag_name in self.last_reported_values and self.last_reported_values[tag_name] == value:
+            self._suppress_interrupt(tag_name, "duplicates")
+            return
+        self.last_reported_values[tag_name] = value
+        self.interrupt_stats["forwarded"] += 1
+        self.event_queue.put_nowait(payload)
+
+    def _suppress_interrupt(self, tag_name: str, reason: str):
+        self.interrupt_stats[reason] += 1
+        self.suppressed_interrupts[tag_name] += 1
+
+    def reset_reported_values(self, tags: List[Dict]):
+        """Forgets the last published poll values so the first poll after a reconnect is always reported."""
+        for tag in tags:
+            self.last_reported_values.pop(tag['tag_name'], None)
+
+    async def route_command_to_mc(self, command: Dict[str, Any], priority: int = PRIORITY_READ) -> Dict[str, Any]:
+        """Routes a command, creates a future for its response, and sends it. `priority` is the lane for reads."""
         tag_name = command.get("tag_name")
         if not tag_name: return {"status": "error", "message": "Command missing 'tag_name'"}
 
-        mc_client = self.tag_to_mc_map.get(tag_name)
-        if not mc_client: return {"status": "error", "message": f"No microcontroller found for tag '{tag_name}'"}
+        route = self.tag_routes.get(tag_name)
+        if not route: return {"status": "error", "message": f"No microcontroller found for tag '{tag_name}'"}
 
-        tag_config = self.tag_map.get(tag_name, {})
-        esp32_command, request_key = self._build_esp32_command_and_key(command, tag_config, mc_client)
+        action = command.get("action")
+        # Serve reads that tolerate some staleness straight from the tag cache
+        if action == "read" and command.get("max_age_ms") is not None:
+            cached = self.get_cached_value(tag_name, float(command["max_age_ms"]))
+            if cached is not None:
+                return cached
 
-        if esp32_command is None:
+        if action == "read":
+            return await self._singleflight_read(route, priority)
+        elif action == "write":
+            if route.collapse_writes:
+                return await self._submit_collapsed_write(route, command.get("value"))
+            return await self._write_tag(route, command.get("value"))
+        elif action == "direct_command" and command.get("payload") is not None:
+            ### This change for gateway_server to replicate close lid.
+            logger.info(f"Direct command received {command}")
+            await route.mc_client.send_command(command["payload"])
+            return {"status": "ok", "message": "Direct command sent."}
+        else:
             return {"status": "error", "message": "Unsupported action or invalid command format"}
 
-        if command.get("action") == "direct_command":
-            await mc_client.send_command(esp32_command)
-            return {"status": "ok", "message": "Direct command sent."}
+    async def _read_tag(self, route: TagRoute, priority: int,
+                        esp32_command: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        response = await self._request_mc(route.mc_client, esp32_command or dict(route.read_command), priority)
+        if response.get("status") == "ok" and "value" in response:
+            self.update_tag_cache(route.tag_name, response["value"])
+        return response
 
-        if not esp32_command or not request_key:
-            return {"status": "error", "message": "Could not build a valid command"}
+    async def _write_tag(self, route: TagRoute, value: Any, priority: Optional[int] = None) -> Dict[str, Any]:
+        # A read already in flight may return the value from before this write; don't let new reads join it
+        self.in_flight_reads.pop(route.read_key, None)
+        esp32_command = dict(route.write_command)
+        esp32_command["value"] = value
+        response = await self._request_mc(route.mc_client, esp32_command,
+                                          route.write_priority if priority is None else priority)
+        if response.get("status") == "ok" and "value" in response:
+            self.update_tag_cache(route.tag_name, response["value"])
+        return response
 
-        # Create a future for this specific request
-        future = asyncio.get_running_loop().create_future()
-        self.pending_requests[request_key].append(future)
+    async def _singleflight_read(self, route: TagRoute, priority: int) -> Dict[str, Any]:
+        """
+        Concurrent identical reads share one MC request; each caller gets its own copy of the response.
+        The shared request goes out in the most urgent lane among its callers.
+        """
+        flight = self.in_flight_reads.get(route.read_key)
+        if flight is None:
+            flight = {"command": dict(route.read_command), "priority": priority}
+
+            async def read():
+                # The lane is taken when the request is queued, after callers joining in the same tick
+                return await self._read_tag(route, flight["priority"], flight["command"])
+
+            flight["future"] = asyncio.ensure_future(read())
+            self.in_flight_reads[route.read_key] = flight
+            flight["future"].add_done_callback(lambda _, key=route.read_key: self._end_read_flight(key, flight))
+        elif priority < flight["priority"]:
+            flight["priority"] = priority
+            route.mc_client.raise_priority(flight["command"], priority)
+        # Shielded so one caller giving up does not cancel the read for the others
+        return dict(await asyncio.shield(flight["future"]))
+
+    def _end_read_flight(self, key: Tuple, flight: Dict[str, Any]):
+        # A write may already have replaced this read with a newer one
+        if self.in_flight_reads.get(key) is flight:
+            del self.in_flight_reads[key]
 
-        # Send the command to the microcontroller
-        await mc_client.send_command(esp32_command)
+    def _submit_collapsed_write(self, route: TagRoute, value: Any) -> asyncio.Future:
+        """
+        Last-write-wins for tags with collapse_writes: while a write to the tag is in flight, newer writes
+        only replace the pending value, and every caller waiting on it gets the response of the write
+        that finally went out.
+        """
+        slot = self.collapsed_writes.get(route.tag_name)
+        if slot is None:
+            slot = self.collapsed_writes[route.tag_name] = {"value": value, "waiters": []}
+            asyncio.create_task(self._drain_collapsed_writes(route, slot))
+        slot["value"] = value
+        waiter = asyncio.get_running_loop().create_future()
+        slot["waiters"].append(waiter)
+        return waiter
 
+    async def _drain_collapsed_writes(self, route: TagRoute, slot: Dict[str, Any]):
         try:
-            # Wait for the future to be resolved by the listener task
-            return await asyncio.wait_for(future, timeout=5.0)
+            while slot["waiters"]:
+                value, waiters = slot["value"], slot["waiters"]
+                slot["waiters"] = []
+                try:
+                    response = await self._write_tag(route, value)
+                except Exception as e:
+                    response = {"status": "error", "message": str(e)}
+                if len(waiters) > 1:
+                    response = {**response, "collapsed_writes": len(waiters)}
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(dict(response))
+        finally:
+            self.collapsed_writes.pop(route.tag_name, None)
+
+    # --- Scheduled writes ---
+
+    def route_schedule_command(self, command: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        schedule_writes: run `writes` in order, stopping at a write that keeps failing, at `at` (epoch
+                         seconds) or after `delay_sec`.
+        extend_schedule: move a pending schedule by `delay_sec`, or to `at`.
+        cancel_schedule / get_schedule: by `schedule_id`.
+        """
+        action = command.get("action")
+        if action == "schedule_writes":
+            return self._schedule_writes(command)
+        entry = self.schedules.get(str(command.get("schedule_id")))
+        if entry is None:
+            return {"status": "error", "message": f"Unknown schedule '{command.get('schedule_id')}'"}
+        if action == "get_schedule":
+            return {"status": "ok", **self._schedule_view(entry)}
+        if entry["state"] != "pending":
+            return {"status": "error", "message": f"Schedule is already {entry['state']}", **self._schedule_view(entry)}
+        if action == "cancel_schedule":
+            entry["handle"].cancel()
+            self._finish_schedule(entry, "cancelled")
+        else:  # extend_schedule
+            if command.get("at") is not None:
+                entry["due_at"] = float(command["at"])
+            elif command.get("delay_sec") is not None:
+                entry["due_at"] += float(command["delay_sec"])
+            else:
+                return {"status": "error", "message": "extend_schedule needs 'delay_sec' or 'at'"}
+            self._arm_schedule(entry)
+        return {"status": "ok", **self._schedule_view(entry)}
+
+    def _schedule_writes(self, command: Dict[str, Any]) -> Dict[str, Any]:
+        writes = [{"tag_name": w.get("tag_name"), "value": w.get("value")} for w in command.get("writes") or []]
+        unknown = [w["tag_name"] for w in writes if w["tag_name"] not in self.tag_routes]
+        if not writes or unknown:
+            return {"status": "error", "message": f"schedule_writes needs known tags to write (unknown: {unknown})"}
+        if command.get("at") is not None:
+            due_at = float(command["at"])
+        elif command.get("delay_sec") is not None:
+            due_at = time.time() + float(command["delay_sec"])
+        else:
+            return {"status": "error", "message": "schedule_writes needs 'delay_sec' or 'at'"}
+
+        schedule_id = str(command.get("schedule_id") or next(self._schedule_ids))
+        previous = self.schedules.get(schedule_id)
+        if previous and previous["state"] == "pending":
+            previous["handle"].cancel()  # Re-scheduling under the same id replaces the old one
+        entry = {"schedule_id": schedule_id, "writes": writes, "due_at": due_at, "state": "pending",
+                 "results": None, "handle": None}
+        self.schedules[schedule_id] = entry
+        self._arm_schedule(entry)
+        logger.info(f"Scheduled {writes} as '{schedule_id}' in {due_at - time.time():.1f} s")
+        return {"status": "ok", **self._schedule_view(entry)}
+
+    def _arm_schedule(self, entry: Dict[str, Any]):
+        if entry["handle"]:
+            entry["handle"].cancel()
+        # Timers run on the monotonic loop clock, so wall clock jumps only affect the conversion here
+        entry["handle"] = asyncio.get_running_loop().call_later(
+            max(0.0, entry["due_at"] - time.time()), lambda: asyncio.ensure_future(self._run_schedule(entry)))
+
+    async def _run_schedule(self, entry: Dict[str, Any]):
+        entry["state"], entry["handle"] = "running", None
+        results = []
+        give_up_at = time.monotonic() + SCHEDULE_RETRY_WINDOW_SEC
+        for write in entry["writes"]:
+            while True:
+                response = await self.route_command_to_mc({"action": "write", **write}, PRIORITY_WRITE)
+                if response.get("status") == "ok" or time.monotonic() >= give_up_at:
+                    break
+                await asyncio.sleep(SCHEDULE_RETRY_INTERVAL_SEC)
+            results.append({"tag_name": write["tag_name"], **response})
+            if response.get("status") != "ok":
+                break
+        failed = results[-1].get("status") != "ok"
+        # Writes after the failed one were never sent
+        results.extend({"tag_name": w["tag_name"], "status": "error", "message": "Not sent: an earlier write failed"}
+                       for w in entry["writes"][len(results):])
+        entry["results"] = results
+        self._finish_schedule(entry, "failed" if failed else "done")
+        log = logger.error if failed else logger.info
+        log(f"Schedule '{entry['schedule_id']}' {entry['state']}: {entry['results']}")
+
+    def _finish_schedule(self, entry: Dict[str, Any], state: str):
+        entry["state"], entry["handle"] = state, None
+        self._finished_schedules.append(entry)
+        while len(self._finished_schedules) > SCHEDULE_HISTORY:
+            old = self._finished_schedules.popleft()
+            if self.schedules.get(old["schedule_id"]) is old:
+                del self.schedules[old["schedule_id"]]
+
+    @staticmethod
+    def _schedule_view(entry: Dict[str, Any]) -> Dict[str, Any]:
+        view = {k: entry[k] for k in ("schedule_id", "writes", "due_at", "state", "results")}
+        view["remaining_sec"] = max(0.0, round(entry["due_at"] - time.time(), 3))
+        return view
+
+    def check_interlocks(self, tag_name: str, value: Any):
+        """Called for every interrupt: starts the writes of each rule on this tag whose condition holds."""
+        for rule in self.interlocks.get(tag_name, ()):
+            try:
+                holds = rule.compare(value, rule.value)
+            except Exception as e:
+                # Never let a rule raise into the MC listener: that would drop the connection
+                self.interlock_stats["failed"] += 1
+                logger.error(f"Interlock '{rule.name}' could not evaluate {tag_name}={value!r}: {e!r}")
+                continue
+            if holds:
+                asyncio.ensure_future(self._fire_interlock(rule, value))
+
+    async def _fire_interlock(self, rule: Interlock, value: Any):
+        started_at = time.monotonic()
+        responses = await asyncio.gather(*(self._write_tag(self.tag_routes[tag_name], target, PRIORITY_SAFETY)
+                                           for tag_name, target in rule.writes))
+        elapsed_ms = (time.monotonic() - started_at) * 1000.0
+        if all(response.get("status") == "ok" for response in responses):
+            self.interlock_stats["fired"] += 1
+            logger.warning(f"Interlock '{rule.name}' fired on {rule.tag_name}={value}: "
+                           f"wrote {list(rule.writes)} in {elapsed_ms:.1f} ms")
+        else:
+            self.interlock_stats["failed"] += 1
+            logger.error(f"Interlock '{rule.name}' on {rule.tag_name}={value} failed: {responses}")
+
+    async def _request_mc(self, mc_client: 'MicrocontrollerClient', esp32_command: Dict,
+                          priority: int = PRIORITY_READ) -> Dict[str, Any]:
+        """Sends one command to a microcontroller and waits for the response carrying the same req_id."""
+        # Tag the command with a unique req_id; the listener resolves the future by that id alone
+        req_id = next(self._req_ids)
+        esp32_command["req_id"] = req_id
+        future = mc_client.register_request(req_id)
+        mc_client.metrics["requests"] += 1
+        started_at = time.monotonic()
+
+        try:
+            await mc_client.send_command(esp32_command, priority)
+            # Resolved by the listener, failed on disconnect, or expired by the MC client's deadline timer
+            response = await future
+            mc_client.latency.observe(time.monotonic() - started_at)
+            response.pop("req_id", None)  # Gateway-internal; client-tagged replies get the client's own
+            return response
         except asyncio.TimeoutError:
-            # Clean up the future if it timed out
-            if future in self.pending_requests[request_key]:
-                self.pending_requests[request_key].remove(future)
+            mc_client.metrics["timeouts"] += 1
             return {"status": "error", "message": "Response timeout from microcontroller"}
+        except ConnectionError as e:
+            # Fail fast: a disconnected MC answers immediately instead of tying the caller up
+            mc_client.metrics["errors"] += 1
+            return {"status": "error", "message": str(e)}
+        finally:
+            mc_client.release_request(req_id)
 
-    def _build_esp32_command_and_key(self, incoming_cmd: Dict, tag_config: Dict, mc_client) -> Tuple[
-        Optional[Dict], Optional[Tuple]]:
-        """Builds the ESP32 command and a unique key for tracking the request."""
-        action, value = incoming_cmd.get("action"), incoming_cmd.get("value")
-        print(f"DEBUG: Building command for action '{action}', tag_config: {tag_config}")
-        is_pcf = "pcf_addr" in tag_config and "pcf_pin" in tag_config
-        slave_id, start_add = tag_config["slave_id"], tag_config.get("start_add")
-        pcf_addr_str, pcf_pin = (tag_config["pcf_addr"], tag_config["pcf_pin"]) if is_pcf else (None, None)
-        mc_key = (mc_client.host, mc_client.port)
-        function_code = tag_config["function_code"]
+    async def route_many_to_mcs(self, command: Dict[str, Any], priority: int = PRIORITY_READ) -> Dict[str, Any]:
+        """
+        Handles read_many / write_many. Sub-commands are grouped by microcontroller and sent
+        concurrently; within one microcontroller the writes go out in request order, so a
+        "motor off, then lid open" pair keeps its ordering on the wire. For that they share one send
+        lane (the most urgent of their tags) and skip collapse_writes, which could otherwise reorder
+        or merge them.
+        """
+        action = command.get("action")
+        if action == "read_many":
+            sub_commands = [{"action": "read", "tag_name": tag, "max_age_ms": command.get("max_age_ms")}
+                            for tag in command.get("tags", [])]
+        else:
+            sub_commands = [{"action": "write", "tag_name": w.get("tag_name"), "value": w.get("value")}
+                            for w in command.get("writes", [])]
+        if not sub_commands:
+            return {"status": "error", "message": f"'{action}' needs a non-empty list of tags"}
 
-        ### This change for gateway_server to replicate close lid.
-        if action == "direct_command":
-            print(f"Direct command received {incoming_cmd}")
-            payload = incoming_cmd.get("payload")
-            return payload, None  # No response key needed
+        groups = defaultdict(list)
+        for index, sub_command in enumerate(sub_commands):
+            groups[self.tag_to_mc_map.get(sub_command["tag_name"])].append((index, sub_command))
 
-        command, req_key = None, None
+        results: List[Optional[Dict[str, Any]]] = [None] * len(sub_commands)
 
-        if action == "read":
-            if is_pcf:
-                command = {"cmd": "pcf_read", "slave_id": slave_id, "addr": int(pcf_addr_str, 16), "pin": pcf_pin}
-                req_key = ("pcf_read", *mc_key, slave_id, pcf_addr_str, pcf_pin)
+        async def run_group(mc_client, items):
+            if action == "read_many" and mc_client is not None:
+                coroutines = self._plan_group_reads(mc_client, items, command.get("max_age_ms"), priority)
+            elif mc_client is not None:
+                routes = [self.tag_routes[sub["tag_name"]] for _, sub in items]
+                lane = min(route.write_priority for route in routes)
+                coroutines = [self._write_tag(route, sub["value"], lane) for route, (_, sub) in zip(routes, items)]
             else:
-                if function_code == "Read Pin":
-                    command = {"cmd": "read", "slave_id": slave_id, "pin": start_add}
-                    req_key = ("read", *mc_key, slave_id, start_add)
-                else:
-                    command = {"cmd": "modbus_read", "slave_id": slave_id, "register": start_add}
-                    req_key = ("modbus_read", *mc_key, slave_id, start_add)
-            return command, req_key  # ADD THIS RETURN FOR READ ACTIONS
+                coroutines = [self.route_command_to_mc(sub, priority) for _, sub in items]
+            responses = await asyncio.gather(*coroutines, return_exceptions=True)
+            for (index, sub_command), response in zip(items, responses):
+                if isinstance(response, Exception):
+                    response = {"status": "error", "message": str(response)}
+                results[index] = {"tag_name": sub_command["tag_name"], **response}
 
-        elif action == "write":
-            if is_pcf:
-                command = {
-                    "cmd": "pcf_write",
-                    "slave_id": slave_id,
-                    "addr": int(pcf_addr_str, 16),
-                    "pin": pcf_pin,
-                    "value": value
-                }
-                req_key = ("pcf_write", *mc_key, slave_id, pcf_addr_str, pcf_pin)
-            else:
-                if function_code == "Write Pin":
-                    command = {
-                        "cmd": "write",
-                        "slave_id": slave_id,
-                        "pin": start_add,
-                        "value": value
-                    }
-                    req_key = ("write", *mc_key, slave_id, start_add)
-                else:
-                    command = {
-                        "cmd": "modbus_write",
-                        "slave_id": slave_id,
-                        "register": start_add,
-                        "value": value
-                    }
-                    req_key = ("modbus_write", *mc_key, slave_id, start_add)
-            return command, req_key
-
-        # Return None, None for unsupported actions
-        return None, None
+        await asyncio.gather(*(run_group(mc_client, items) for mc_client, items in groups.items()))
+        all_ok = all(r.get("status") == "ok" for r in results)
+        return {"status": "ok" if all_ok else "error", "results": results}
+
+    def _plan_group_reads(self, mc_client: 'MicrocontrollerClient', items: List[Tuple[int, Dict]],
+                          max_age_ms: Optional[float], priority: int) -> List:
+        """
+        Builds one awaitable per item of a read_many group. Modbus register reads that are not
+        served from the cache are coalesced into block reads and share the block's response.
+        """
+        register_tags = {}
+        for _, sub_command in items:
+            tag_name = sub_command["tag_name"]
+            tag_config = self.tag_map.get(tag_name, {})
+            if not is_modbus_register_tag(tag_config) or tag_config.get("slave_id") in mc_client.no_block_reads:
+                continue
+            if max_age_ms is not None and self.get_cached_value(tag_name, float(max_age_ms)) is not None:
+                continue
+            register_tags[tag_name] = tag_config
+
+        block_results: Dict[str, asyncio.Future] = {}
+        if len(register_tags) > 1:
+            for block in plan_modbus_block_reads(list(register_tags.values()), self.register_gap,
+                                                 slave_gaps=self.slave_register_gaps):
+                if len(block["tags"]) < 2:
+                    continue  # A lone register is read the usual way
+                task = asyncio.ensure_future(self._read_modbus_block(mc_client, block, priority))
+                for tag_name, _, _ in block["tags"]:
+                    block_results[tag_name] = task
+
+        async def from_block(tag_name):
+            return (await block_results[tag_name])[tag_name]
+
+        return [from_block(sub["tag_name"]) if sub["tag_name"] in block_results
+                else self.route_command_to_mc(sub, priority) for _, sub in items]
+
+    async def _read_modbus_block(self, mc_client: 'MicrocontrollerClient', block: Dict[str, Any],
+                                 priority: int) -> Dict[str, Dict]:
+        """
+        Reads one coalesced register block and splits it into per-tag responses. If the MC rejects the
+        block or answers without a full "values" list, the tags are read one by one instead; a slave
+        whose firmware ignores "length" is not sent block reads again.
+        """
+        command = {"cmd": "modbus_read", "slave_id": block["slave_id"], "register": block["register"],
+                   "length": block["length"]}
+        try:
+            response = await self._request_mc(mc_client, command, priority)
+        except ConnectionError as e:
+            response = {"status": "error", "message": str(e)}
+        values = response.get("values")
+        if response.get("status") != "ok" or not isinstance(values, list) or len(values) < block["length"]:
+            if response.get("status") == "ok" and not isinstance(values, list):
+                mc_client.no_block_reads.add(block["slave_id"])
+                logger.warning(f"{mc_client.host}:{mc_client.port} answered a block read of slave "
+                               f"{block['slave_id']} without values; reading its registers one by one.")
+            tag_names = [tag_name for tag_name, _, _ in block["tags"]]
+            responses = await asyncio.gather(*(self.route_command_to_mc({"action": "read", "tag_name": tag_name},
+                                                                        priority) for tag_name in tag_names))
+            return dict(zip(tag_names, responses))
+        results = split_modbus_block_result(block, response)
+        for tag_name, result in results.items():
+            if result["status"] == "ok":
+                self.update_tag_cache(tag_name, result["value"])
+        return results
 
 # --- Client for a single Microcontroller ---
 
 class MicrocontrollerClient:
     """Manages a connection to one ESP32 and routes its responses."""
 
-    def __init__(self, host: str, port: int, tags: List[Dict], manager: GatewayManager):
+    def __init__(self, host: str, port: int, tags: List[Dict], manager: GatewayManager,
+                 max_in_flight: int = MC_MAX_IN_FLIGHT):
         self.host, self.port, self.tags, self.manager = host, port, tags, manager
-        self.reader, self.writer, self.is_connected = None, None, False
+        self.connection: Optional[FrameProtocol] = None
+        self.is_connected = False
+        # Framing negotiated on connect; firmware that does not answer the hello keeps JSON lines
+        self.codec = JSON_CODEC
+        self._offer_codecs = True
+        # Single writer task fed by a priority heap of (priority, seq, command)
+        self.max_in_flight = max_in_flight
+        self._send_heap: List[Tuple[int, int, Dict]] = []
+        self._send_seq = itertools.count()
+        self._send_ready = asyncio.Event()
+        self._writer_task: Optional[asyncio.Task] = None
+        # req_id -> future of every request to this MC, plus a heap of (deadline, req_id) for expiry.
+        # Heap entries of requests that were already answered are skipped when they come up.
+        self.pending_requests: Dict[int, asyncio.Future] = {}
+        self._deadlines: List[Tuple[float, int]] = []
+        self._expiry_handle: Optional[asyncio.TimerHandle] = None
+        # req_ids written to the MC and not yet answered
+        self.in_flight_ids: Set[int] = set()
+        # Round-trip times (seconds) measured from socket write to response
+        self._write_times: Dict[int, float] = {}
+        self.rtt_samples = deque(maxlen=RTT_WINDOW)
+        self.rtt_p50, self.rtt_p99 = None, None
+        self._samples_since_update = 0
+        self.last_received_at = 0.0
+        # Heartbeat probes are kept out of the request metrics and the RTT window
+        self._probe_ids: Set[int] = set()
+        self._ping_supported = True  # Cleared once the firmware rejects or ignores "ping"
+        # When the MC acknowledged the current interrupt subscription (None until it has)
+        self.subscribed_at: Optional[float] = None
+        self._subscribing: List[Dict[str, Any]] = []  # Pins of the subscribe command awaiting its ack
+        # Counters reported by the stats action; latency is measured from queueing to response
+        self.metrics = {"requests": 0, "timeouts": 0, "errors": 0, "uncorrelated": 0, "reconnects": 0}
+        self.latency = LatencyHistogram()
+        self._has_connected = False
+        # slave_ids whose firmware answered a block read without "values" (see _read_modbus_block)
+        self.no_block_reads: Set[Any] = set()
 
     async def run(self):
-        # Auto-reconnection loop
+        # Auto-reconnection loop with exponential backoff and jitter
+        delay = RECONNECT_INITIAL_DELAY_SEC
         while True:
+            heartbeat_task = None
             try:
                 logger.info(f"Attempting to connect to microcontroller at {self.host}:{self.port}...")
-                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+                _, self.connection = await asyncio.wait_for(
+                    asyncio.get_running_loop().create_connection(lambda: FrameProtocol(self._dispatch),
+                                                                 self.host, self.port),
+                    timeout=CONNECT_TIMEOUT_SEC)
                 self.is_connected = True
+                if self._has_connected:
+                    self.metrics["reconnects"] += 1
+                self._has_connected = True
+                self.last_received_at = time.monotonic()
+                delay = RECONNECT_INITIAL_DELAY_SEC
                 logger.info(f"✅ Connection successful to {self.host}:{self.port}")
+                self.codec = await self._negotiate_codec()
+                self._writer_task = asyncio.create_task(self._writer_loop())
+                heartbeat_task = asyncio.create_task(self._heartbeat())
                 await self._send_subscribe_command()
                 await self._listener()
             except (ConnectionError, asyncio.TimeoutError, OSError) as e:
                 logger.error(f"Could not connect to {self.host}:{self.port}. Reason: {e}")
             finally:
                 self.is_connected = False
+                self.subscribed_at = None
+                if heartbeat_task:
+                    heartbeat_task.cancel()
+                if self._writer_task:
+                    self._writer_task.cancel()
+                if self.connection:
+                    self.connection.close()
+                self._send_heap.clear()
+                self.in_flight_ids.clear()
+                self._write_times.clear()
                 self._fail_pending_requests()
-                logger.info(f"Disconnected from {self.host}:{self.port}. Retrying in 10 seconds...")
-                await asyncio.sleep(10)
+                self.manager.invalidate_tag_cache(self.tags)
+                self.manager.reset_reported_values(self.tags)
+                retry_in = delay * random.uniform(0.5, 1.0)
+                logger.info(f"Disconnected from {self.host}:{self.port}. Retrying in {retry_in:.1f} seconds...")
+                await asyncio.sleep(retry_in)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY_SEC)
+
+    async def _negotiate_codec(self):
+        """Offers the binary codecs; once an MC turns them down it is not asked again."""
+        if not self._offer_codecs:
+            return JSON_CODEC
+        try:
+            codec = await self.connection.negotiate({"cmd": "hello"}, self.manager.wire_codecs)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self.host}:{self.port} did not answer the codec hello, using JSON lines.")
+            codec = JSON_CODEC
+        if codec is JSON_CODEC:
+            self._offer_codecs = False
+        logger.info(f"Using {codec.name} framing with {self.host}:{self.port}")
+        return codec
+
+    async def _heartbeat(self):
+        """Probes the MC when the link has been quiet; no answer means a half-open socket, so drop it."""
+        while self.is_connected:
+            await asyncio.sleep(HEARTBEAT_INTERVAL_SEC)
+            if time.monotonic() - self.last_received_at < HEARTBEAT_INTERVAL_SEC:
+                continue
+            if not await self._link_alive():
+                logger.error(f"Heartbeat to {self.host}:{self.port} timed out, closing the connection.")
+                self.connection.close()
+                return
+
+    async def _link_alive(self) -> bool:
+        """Any frame received while the probe is outstanding counts as proof of life, not only its reply."""
+        sent_at = time.monotonic()
+        if self._ping_supported:
+            try:
+                response = await self._probe({"cmd": "ping"})
+                if response.get("status") == "error":
+                    # Answered, so alive; later probes use a read this firmware understands
+                    logger.info(f"{self.host}:{self.port} rejected ping ({response.get('message')}), "
+                                f"probing with a tag read instead.")
+                    self._ping_supported = False
+                return True
+            except asyncio.TimeoutError:
+                if self.last_received_at >= sent_at:
+                    return True
+        read_command = self._probe_read_command()
+        if read_command is None:
+            return False
+        try:
+            await self._probe(read_command)
+        except asyncio.TimeoutError:
+            return self.last_received_at >= sent_at
+        if self._ping_supported:
+            # Firmware that silently drops unknown commands
+            logger.info(f"{self.host}:{self.port} ignored ping but answered a read, probing with reads from now on.")
+            self._ping_supported = False
+        return True
+
+    def _probe_read_command(self) -> Optional[Dict[str, Any]]:
+        """Read command of this MC's first routed tag, used as a harmless probe when ping is unsupported."""
+        for tag in self.tags:
+            route = self.manager.tag_routes.get(tag.get("tag_name"))
+            if route is not None:
+                return dict(route.read_command)
+        return None
+
+    async def _probe(self, command: Dict[str, Any]) -> Dict[str, Any]:
+        """Sends a heartbeat probe outside the request metrics; raises asyncio.TimeoutError if unanswered."""
+        req_id = next(self.manager._req_ids)
+        command["req_id"] = req_id
+        future = self.register_request(req_id)
+        self._probe_ids.add(req_id)
+        try:
+            await self.send_command(command, PRIORITY_SAFETY)
+            return await future
+        finally:
+            self._probe_ids.discard(req_id)
+            self.release_request(req_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "connected": self.is_connected,
+            "codec": self.codec.name,
+            **self.metrics,
+            "in_flight": len(self.in_flight_ids),
+            "queued": len(self._send_heap),
+            "rtt_p50_ms": round(self.rtt_p50 * 1000.0, 3) if self.rtt_p50 is not None else None,
+            "rtt_p99_ms": round(self.rtt_p99 * 1000.0, 3) if self.rtt_p99 is not None else None,
+            "latency_ms": self.latency.snapshot(),
+        }
+
+    def request_timeout(self) -> float:
+        """Response timeout for a request queued now, derived from observed RTT percentiles and the backlog."""
+        if self.rtt_p99 is None:
+            return REQUEST_TIMEOUT_MAX_SEC
+        base = min(max(self.rtt_p99 * RTT_TIMEOUT_MULTIPLIER, REQUEST_TIMEOUT_MIN_SEC), REQUEST_TIMEOUT_MAX_SEC)
+        backlog = len(self._send_heap) + len(self.in_flight_ids)
+        return min(base + backlog * self.rtt_p50, REQUEST_TIMEOUT_MAX_SEC)
+
+    def _record_rtt(self, req_id):
+        written_at = self._write_times.pop(req_id, None)
+        if written_at is None or req_id in self._probe_ids:
+            return
+        self.rtt_samples.append(time.monotonic() - written_at)
+        self._samples_since_update += 1
+        # Re-sorting the window on every response is wasteful; refresh the percentiles periodically
+        if len(self.rtt_samples) >= RTT_MIN_SAMPLES and (self.rtt_p99 is None or self._samples_since_update >= 32):
+            ordered = sorted(self.rtt_samples)
+            self.rtt_p50 = ordered[len(ordered) // 2]
+            self.rtt_p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+            self._samples_since_update = 0
+
+    def register_request(self, req_id: int) -> asyncio.Future:
+        """Creates the future for a request and arms its deadline (see request_timeout)."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending_requests[req_id] = future
+        deadline = loop.time() + self.request_timeout()
+        heapq.heappush(self._deadlines, (deadline, req_id))
+        if self._expiry_handle is None or self._expiry_handle.when() > deadline:
+            if self._expiry_handle:
+                self._expiry_handle.cancel()
+            self._expiry_handle = loop.call_at(deadline, self._expire_requests)
+        return future
+
+    def _expire_requests(self):
+        """Times out every request whose deadline has passed, then re-arms the timer for the next one."""
+        self._expiry_handle = None
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, req_id = heapq.heappop(self._deadlines)
+            future = self.pending_requests.pop(req_id, None)
+            if future and not future.done():
+                future.set_exception(asyncio.TimeoutError())
+        if self._deadlines:
+            self._expiry_handle = loop.call_at(self._deadlines[0][0], self._expire_requests)
 
     def _fail_pending_requests(self):
         """On disconnect, fail any requests that were waiting for a response from this micro."""
-        mc_key = (self.host, self.port)
-        for req_key, future_queue in list(self.manager.pending_requests.items()):
-            if req_key[1:3] == mc_key:
-                for future in future_queue:
-                    future.set_exception(ConnectionError(f"Connection to {self.host}:{self.port} was lost."))
-                del self.manager.pending_requests[req_key]
+        for future in self.pending_requests.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"Connection to {self.host}:{self.port} was lost."))
+        self.pending_requests.clear()
+        self._deadlines.clear()
+        if self._expiry_handle:
+            self._expiry_handle.cancel()
+            self._expiry_handle = None
 
     async def _listener(self):
-        """Listens for all data and routes it to the correct future or event queue."""
-        while self.is_connected:
-            data = await self.reader.readline()
-            if not data: raise ConnectionError("Microcontroller closed connection")
-            payload = json.loads(data.decode().strip())
+        """Waits for the connection to drop; incoming frames are routed by _dispatch as they arrive."""
+        exc = await self.connection.closed
+        raise ConnectionError(f"Microcontroller closed connection{f' ({exc})' if exc else ''}")
 
+    def _dispatch(self, messages: List[Dict[str, Any]]):
+        """Routes every frame of one received chunk to the correct future or the event queue."""
+        self.last_received_at = time.monotonic()
+        for payload in messages:
             if payload.get("event") == "gpio_interrupt":
-                await self.manager.event_queue.put(payload)
+                tag_name = self.manager.get_tag_for_event(payload)
+                if tag_name:
+                    payload['tag_name'] = tag_name
+                    self.manager.update_tag_cache(tag_name, payload.get("value"))
+                    self.manager.check_interlocks(tag_name, payload.get("value"))
+                    self.manager.report_interrupt(tag_name, payload)
+                else:
+                    self.manager.event_queue.put_nowait(payload)
                 continue
 
-            # --- NEW: Correlate response to a pending request future ---
-            mc_key = (self.host, self.port)
-            # Infer the request key from the response payload
-            print(f"Payload from simulator {payload}")
-            if "pin" in payload:
-                is_write_response = payload.get("io_type")
-                action = "write" if is_write_response == "Write Pin" else "read"
-                req_key = (action, *mc_key, payload.get("slave_id"), payload.get("pin"))
-            elif "register" in payload:  # It's a Modbus response
-                action = "modbus_write" if "value" in payload and "status" in payload else "modbus_read"
-                req_key = (action, *mc_key, payload.get("slave_id"), payload.get("register"))
-            elif "addr" in payload:  # It's a PCF response
-                action = "pcf_write" if "value" in payload and "status" in payload else "pcf_read"
-                req_key = (action, *mc_key, payload.get("slave_id"), payload.get("addr"), payload.get("pin"))
-            else:
-                req_key = None
-
-            # Find the queue of futures for this key and resolve the oldest one
-            if req_key and req_key in self.manager.pending_requests:
-                future_queue = self.manager.pending_requests[req_key]
-                if future_queue:
-                    future = future_queue.popleft()
-                    future.set_result(payload)
-                if not future_queue:
-                    del self.manager.pending_requests[req_key]  # Clean up empty deque
-                print(f"[Gateway] Response from simulator: {payload}")
+            if "subscribed_to" in payload and payload.get("req_id") is None:
+                # Firmware that does not echo req_id on the subscribe reply
+                self._check_subscription_ack(payload)
+                continue
+
+            # Correlate the response to its pending request by the echoed req_id
+            future = self.pending_requests.pop(payload.get("req_id"), None)
+            self._record_rtt(payload.get("req_id"))
+            self.release_request(payload.get("req_id"))
+            if future and not future.done():
+                future.set_result(payload)
             else:
+                self.metrics["uncorrelated"] += 1
                 logger.warning(f"Received uncorrelated response from {self.host}:{self.port}: {payload}")
 
-    async def send_command(self, command: Dict):
-        """Sends a pre-formatted command to the microcontroller."""
+    async def send_command(self, command: Dict, priority: int = PRIORITY_WRITE):
+        """Queues a pre-formatted command for the writer task in the given send lane."""
         if not self.is_connected:
             raise ConnectionError("Microcontroller not connected")
-        message = (json.dumps(command) + "\n").encode()
-        self.writer.write(message)
-        await self.writer.drain()
-        logger.info(f"--> Sent to {self.host}:{self.port}: {command}")
+        heapq.heappush(self._send_heap, (priority, next(self._send_seq), command))
+        self._send_ready.set()
 
-    async def _send_subscribe_command(self):
-        """Builds and sends the subscribe command."""
-        # This function remains the same as the previous version
+    def raise_priority(self, command: Dict, priority: int):
+        """Moves a command that is still queued to a more urgent lane; no-op once it has been sent."""
+        for index, (queued_priority, seq, queued) in enumerate(self._send_heap):
+            if queued is command:
+                if priority < queued_priority:
+                    self._send_heap[index] = (priority, seq, queued)
+                    heapq.heapify(self._send_heap)
+                    self._send_ready.set()
+                return
+
+    def release_request(self, req_id: int):
+        """Forgets an answered, timed-out or abandoned request and frees its in-flight slot."""
+        self.pending_requests.pop(req_id, None)
+        if req_id in self.in_flight_ids:
+            self.in_flight_ids.discard(req_id)
+            self._write_times.pop(req_id, None)
+            self._send_ready.set()
+
+    async def _writer_loop(self):
+        """The only coroutine that writes to the MC socket: highest priority first, FIFO within a lane."""
+        try:
+            while True:
+                await self._send_ready.wait()
+                if not self._send_heap:
+                    self._send_ready.clear()
+                    continue
+                priority, _, command = self._send_heap[0]
+                req_id = command.get("req_id")
+                if (req_id is not None and priority != PRIORITY_SAFETY
+                        and len(self.in_flight_ids) >= self.max_in_flight):
+                    # Window full: wait for a response or for a (possibly safety) command to arrive
+                    self._send_ready.clear()
+                    continue
+                heapq.heappop(self._send_heap)
+                if req_id is not None and req_id not in self.pending_requests:
+                    continue  # The caller already gave up on this request
+                try:
+                    frame = self.connection.codec.encode(command)
+                except Exception as e:
+                    # e.g. an int too big for msgpack: fail this command only, the lane keeps going
+                    logger.error(f"Could not encode command for {self.host}:{self.port}: {e!r}; dropped {command}")
+                    future = self.pending_requests.pop(req_id, None)
+                    if future and not future.done():
+                        future.set_result({"status": "error", "message": f"Could not encode command: {e!r}"})
+                    continue
+                if req_id is not None:
+                    self.in_flight_ids.add(req_id)
+                    self._write_times[req_id] = time.monotonic()
+                self.connection.write(frame)
+                await self.connection.drain()
+                logger.info(f"--> Sent to {self.host}:{self.port}: {command}")
+        except (ConnectionError, OSError) as e:
+            logger.error(f"Write to {self.host}:{self.port} failed: {e}")
+            self.connection.close()
+
+    def subscription_pins(self) -> List[Dict[str, Any]]:
+        """Interrupt sources of this MC's state based tags, as sent in the subscribe command."""
         pins_to_subscribe = []
         for tag in self.tags:
-            if tag.get("event_report") == "state based":
+            if is_state_based(tag):
                 pin_info = {}
                 if "pcf_addr" in tag and "pcf_pin" in tag:
                     pin_info = {"source": "pcf8574", "slave_id": tag["slave_id"], "addr": tag["pcf_addr"],
@@ -274,8 +1507,111 @@ class MicrocontrollerClient:
                 elif "function_code" in tag and "Pin" in tag["function_code"]:
                     pin_info = {"source": "esp32", "slave_id": tag["slave_id"], "pin": tag["start_add"]}
                 if pin_info: pins_to_subscribe.append(pin_info)
+        return pins_to_subscribe
+
+    async def _send_subscribe_command(self):
+        """Sends the subscribe command and waits for the MC to acknowledge it (see _check_subscription_ack)."""
+        self.subscribed_at = None
+        pins_to_subscribe = self.subscription_pins()
         if not pins_to_subscribe: return
-        await self.send_command({"cmd": "subscribe", "pins": pins_to_subscribe, "debounce_ms": 100})
+        self._subscribing = pins_to_subscribe
+        response = await self.manager._request_mc(
+            self, {"cmd": "subscribe", "pins": pins_to_subscribe, "debounce_ms": 100}, PRIORITY_SAFETY)
+        if self.subscribed_at is None and not self._check_subscription_ack(response):
+            logger.error(f"{self.host}:{self.port} did not confirm the interrupt subscription: {response}")
+
+    def _check_subscription_ack(self, response: Dict[str, Any]) -> bool:
+        """Marks the subscription as confirmed if the MC accepted every pin it was asked for."""
+        pins = [pin_info["pin"] for pin_info in self._subscribing]
+        subscribed_to = response.get("subscribed_to")
+        if response.get("status") != "ok" or subscribed_to is None:
+            return False
+        if {str(pin) for pin in pins} - {str(pin) for pin in subscribed_to}:
+            logger.error(f"{self.host}:{self.port} subscribed only to {subscribed_to} of {pins}")
+            return False
+        self.subscribed_at = time.monotonic()
+        logger.info(f"{self.host}:{self.port} acknowledged interrupt subscription: {subscribed_to}")
+        return True
+
+
+# --- Outbound Event Channel for one Subscriber ---
+
+class SubscriberChannel:
+    """
+    Bounded send queue plus a dedicated writer task for one subscribed client, so a slow
+    or stuck client only ever delays its own events.
+    """
+
+    def __init__(self, writer: FrameProtocol, peername, queue_size: int, overflow_policy: str, codec=JSON_CODEC):
+        self.writer, self.peername, self.codec = writer, peername, codec
+        self.queue_size, self.overflow_policy = queue_size, overflow_policy
+        # sequence number -> (tag, message bytes, enqueue time), in delivery order
+        self.pending: "OrderedDict[int, Tuple[str, bytes, float]]" = OrderedDict()
+        self._latest_key: Dict[str, int] = {}  # tag -> key of its newest pending event
+        self._seq = itertools.count()
+        self._has_pending = asyncio.Event()
+        self.closed = False
+        self.metrics = {"sent": 0, "dropped": 0, "last_lag_ms": 0.0, "max_lag_ms": 0.0}
+        self._task = asyncio.create_task(self._writer_loop())
+
+    def enqueue(self, tag_name: str, message: bytes, replay: bool = False):
+        """
+        Queues an event without blocking, in FIFO order; the overflow policy only applies when the
+        queue is full. Replayed events are never coalesced or dropped (the journal bounds them).
+        """
+        if self.closed:
+            return
+        if len(self.pending) >= self.queue_size and not replay:
+            if self.overflow_policy == "disconnect":
+                logger.warning(f"Subscriber {self.peername} is too slow, disconnecting it.")
+                self.close()
+                return
+            self.metrics["dropped"] += 1
+            key = self._latest_key.get(tag_name)
+            if self.overflow_policy == "latest_per_tag" and key is not None:
+                # Replace the tag's newest stale value in place; it keeps its position in the queue
+                self.pending[key] = (tag_name, message, self.pending[key][2])
+                return
+            self._forget(*self.pending.popitem(last=False))
+        key = next(self._seq)
+        self.pending[key] = (tag_name, message, time.monotonic())
+        self._latest_key[tag_name] = key
+        self._has_pending.set()
+
+    def _forget(self, key: int, entry: Tuple[str, bytes, float]):
+        if self._latest_key.get(entry[0]) == key:
+            del self._latest_key[entry[0]]
+
+    async def _writer_loop(self):
+        try:
+            while True:
+                await self._has_pending.wait()
+                while self.pending:
+                    key, entry = self.pending.popitem(last=False)
+                    self._forget(key, entry)
+                    _, message, enqueued_at = entry
+                    self.writer.write(message)
+                    await self.writer.drain()
+                    lag_ms = (time.monotonic() - enqueued_at) * 1000.0
+                    self.metrics["sent"] += 1
+                    self.metrics["last_lag_ms"] = lag_ms
+                    self.metrics["max_lag_ms"] = max(self.metrics["max_lag_ms"], lag_ms)
+                self._has_pending.clear()
+        except (ConnectionError, BrokenPipeError):
+            logger.warning(f"Event delivery to {self.peername} failed, dropping its subscription queue.")
+            self.closed = True
+            self.pending.clear()
+            self._latest_key.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"peer": str(self.peername), "queue_depth": len(self.pending), **self.metrics}
+
+    def close(self):
+        self.closed = True
+        self.pending.clear()
+        self._latest_key.clear()
+        self._task.cancel()
+        self.writer.close()
 
 
 # --- Server for Top-Level Controllers ---
@@ -284,69 +1620,447 @@ class GatewayTCPServer:
     """Accepts connections from top-level clients and handles their requests and event subscriptions."""
 
     # This class is now simplified, as the complex correlation logic is in the Manager
-    def __init__(self, host: str, port: int, manager: GatewayManager):
+    def __init__(self, host: str, port: int, manager: GatewayManager, queue_size: int = SUBSCRIBER_QUEUE_SIZE,
+                 overflow_policy: str = SUBSCRIBER_OVERFLOW_POLICY):
         self.host, self.port, self.manager = host, port, manager
-        self.event_subscriptions = defaultdict(set)
+        self.queue_size, self.overflow_policy = queue_size, overflow_policy
+        self.event_subscriptions: Dict[str, Set[SubscriberChannel]] = defaultdict(set)
         self.client_to_tags_map = defaultdict(set)
+        self.channels: Dict[FrameProtocol, SubscriberChannel] = {}
 
     async def start(self):
-        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        server = await asyncio.get_running_loop().create_server(
+            lambda: FrameProtocol(on_connect=lambda conn: asyncio.create_task(self.handle_client(conn))),
+            self.host, self.port)
         logger.info(f"✅ Gateway TCP Server listening on {self.host}:{self.port}")
         asyncio.create_task(self.forward_events_to_clients())
         async with server:
             await server.serve_forever()
 
+    def stats(self) -> Dict[str, Any]:
+        """Gateway-wide metrics: per-MC counters and latency, event_queue depth and per-subscriber lag."""
+        return {**self.manager.stats(), "subscribers": [channel.stats() for channel in self.channels.values()]}
+
+    async def serve_metrics(self, host: str, port: int):
+        """Optional plain-HTTP endpoint that answers any GET with the metrics in text exposition format."""
+        server = await asyncio.start_server(self._handle_metrics_request, host, port)
+        logger.info(f"✅ Metrics endpoint listening on http://{host}:{port}/metrics")
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_metrics_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Only the request head matters; there is nothing to route on
+            while (await reader.readline()).strip():
+                pass
+            body = format_metrics_text(self.stats()).encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
     async def forward_events_to_clients(self):
         logger.info("Event forwarder for top-level clients started.")
         while True:
             event = await self.manager.event_queue.get()
-            tag_name = self.manager.get_tag_for_event(event)
+            tag_name = event.get('tag_name')
             if not tag_name: continue
-            event['tag_name'] = tag_name
-            message = (json.dumps(event) + "\n").encode()
-            if tag_name in self.event_subscriptions:
-                for writer in list(self.event_subscriptions[tag_name]):
-                    try:
-                        writer.write(message)
-                        await writer.drain()
-                    except (ConnectionError, BrokenPipeError):
-                        pass
+            self.manager.journal.append(event)
+            # Encoded once per codec in use. Never waits on a client: each subscriber drains its own bounded queue
+            frames: Dict[str, bytes] = {}
+            for channel in self.event_subscriptions.get(tag_name, ()):
+                frame = frames.get(channel.codec.name)
+                if frame is None:
+                    frame = frames[channel.codec.name] = channel.codec.encode(event)
+                channel.enqueue(tag_name, frame)
+
+    async def route(self, command: Dict[str, Any]) -> Dict[str, Any]:
+        """Answers one request that is not about the connection itself (hello, subscribe_events)."""
+        action = command.get("action")
+        if action == "stats":
+            return {"status": "ok", **self.stats()}
+        elif action in ("schedule_writes", "extend_schedule", "cancel_schedule", "get_schedule"):
+            return self.manager.route_schedule_command(command)
+        elif action in ("read_many", "write_many"):
+            return await self.manager.route_many_to_mcs(command)
+        else:  # Handle regular read/write commands
+            logger.debug(f"got the command {command}")
+            return await self.manager.route_command_to_mc(command)
+
+    async def _answer_tagged(self, conn: FrameProtocol, command: Dict[str, Any]):
+        try:
+            response = await self.route(command)
+        except Exception as e:
+            logger.error(f"Request {command} failed: {e!r}")
+            response = {"status": "error", "message": str(e)}
+        if conn.closed.done():
+            return
+        # Responses may be shared by coalesced requests, so the req_id goes on a copy
+        conn.send({**response, "req_id": command["req_id"]})
+        try:
+            await conn.drain()
+        except ConnectionError:
+            pass
 
-    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        peername = writer.get_extra_info('peername')
+    async def handle_client(self, conn: FrameProtocol):
+        peername = conn.get_extra_info('peername')
         logger.info(f"✅ Top-level client connected from {peername}")
 
         try:
             while True:
-                data = await reader.readline()
-                if not data: break
-
-                command = json.loads(data.decode().strip())
-                action = command.get("action")
-
-                if action == "subscribe_events":
-                    tags_to_sub = command.get("tags", [])
-                    for tag in tags_to_sub:
-                        self.event_subscriptions[tag].add(writer)
-                        self.client_to_tags_map[writer].add(tag)
-                    logger.info(f"Client {peername} subscribed to events for tags: {tags_to_sub}")
-                    response = {"status": "ok", "subscribed_to_events_for": tags_to_sub}
-                else:  # Handle regular read/write commands
-                    print(f"got the command {command}")
-                    response = await self.manager.route_command_to_mc(command)
-
-                writer.write((json.dumps(response) + "\n").encode())
-                await writer.drain()
-
-        except (ConnectionError, asyncio.IncompleteReadError):
+                # Everything the client sent since the last pass, parsed in one go; answered in order
+                batch = await conn.next_batch()
+                if batch is None: break
+
+                for command in batch:
+                    action = command.get("action")
+
+                    if action == "hello":
+                        # Codec negotiation: the reply still goes out as a JSON line, everything after uses the codec
+                        codec = select_codec(command.get("codecs", []), self.manager.wire_codecs)
+                        conn.write(JSON_CODEC.encode({"status": "ok", "codec": codec.name}))
+                        conn.set_codec(codec)
+                        if conn in self.channels:
+                            self.channels[conn].codec = codec
+                        logger.info(f"Client {peername} uses {codec.name} framing")
+                        continue
+                    elif action == "subscribe_events":
+                        tags_to_sub = command.get("tags", [])
+                        channel = self.channels.get(conn)
+                        if channel is None:
+                            channel = SubscriberChannel(conn, peername, self.queue_size, self.overflow_policy,
+                                                        conn.codec)
+                            self.channels[conn] = channel
+                        for tag in tags_to_sub:
+                            self.event_subscriptions[tag].add(channel)
+                            self.client_to_tags_map[conn].add(tag)
+                        logger.info(f"Client {peername} subscribed to events for tags: {tags_to_sub}")
+                        response = {"status": "ok", "subscribed_to_events_for": tags_to_sub,
+                                    "last_seq": self.manager.journal.last_seq, "epoch": self.manager.journal.epoch}
+                        if command.get("since_seq") is not None:
+                            # The reply goes out first; missed events follow through the channel, then live ones
+                            missed, complete = self.manager.journal.since(int(command["since_seq"]),
+                                                                          command.get("epoch"))
+                            missed = [event for event in missed if event.get("tag_name") in tags_to_sub]
+                            response.update(replayed=len(missed), replay_complete=complete)
+                            conn.send(response)
+                            for event in missed:
+                                channel.enqueue(event["tag_name"], channel.codec.encode(event), replay=True)
+                            logger.info(f"Replayed {len(missed)} events after seq {command['since_seq']} "
+                                        f"to {peername} (complete: {complete})")
+                            continue
+                    elif command.get("req_id") is not None:
+                        # Tagged requests run concurrently and may complete out of order; the reply echoes req_id
+                        asyncio.create_task(self._answer_tagged(conn, command))
+                        continue
+                    else:
+                        response = await self.route(command)
+
+                    conn.send(response)
+                await conn.drain()
+
+        except ConnectionError:
             logger.warning(f"Client {peername} disconnected.")
         finally:
-            if writer in self.client_to_tags_map:
-                for tag in self.client_to_tags_map[writer]:
-                    if tag in self.event_subscriptions: self.event_subscriptions[tag].discard(writer)
-                del self.client_to_tags_map[writer]
-            writer.close()
-            await writer.wait_closed()
+            channel = self.channels.pop(conn, None)
+            if conn in self.client_to_tags_map:
+                for tag in self.client_to_tags_map[conn]:
+                    if tag in self.event_subscriptions: self.event_subscriptions[tag].discard(channel)
+                del self.client_to_tags_map[conn]
+            if channel:
+                logger.info(f"Subscriber {peername} event delivery stats: {channel.stats()}")
+                channel.close()
+            conn.close()
+            await conn.wait_closed()
+
+
+# --- Sharded Gateway ---
+
+def run_shard_worker(config_path: str, options: Dict[str, Any], interlocks: Dict[str, str]):
+    """Entry point of a shard worker process: a GatewayManager for the MCs of one shard."""
+    logging.getLogger().setLevel(options.get("log_level", "INFO").upper())
+    try:
+        asyncio.run(_run_shard_worker(GatewayManager(config_path, options, interlocks)))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _run_shard_worker(manager: GatewayManager):
+    # A worker outliving its router would keep its port, so a restarted router could not start a new one
+    router_pid = os.getppid()
+    gateway = asyncio.ensure_future(manager.start())
+    while not gateway.done():
+        await asyncio.wait([gateway], timeout=SHARD_WORKER_RESTART_DELAY_SEC)
+        if os.getppid() != router_pid:
+            logger.error("Router process is gone; shard worker exiting.")
+            gateway.cancel()
+            break
+    await asyncio.gather(gateway, return_exceptions=True)
+
+
+class ShardLink:
+    """The router's connection to one shard worker: req_id correlated requests plus the worker's event stream."""
+
+    def __init__(self, index: int, host: str, port: int, router: 'GatewayRouter'):
+        self.index, self.host, self.port, self.router = index, host, port, router
+        self.tags: List[str] = []
+        self.connection: Optional[FrameProtocol] = None
+        self.is_connected = False
+        self.pending_requests: Dict[int, asyncio.Future] = {}
+        self._req_ids = itertools.count(1)
+        # Seq and epoch of the last event received in the worker's own journal, to replay from after a reconnect
+        self.last_seq: Optional[int] = None
+        self.epoch: Optional[str] = None
+        # Latest result of the worker's stats action, refreshed by the heartbeat
+        self.worker_stats: Dict[str, Any] = {}
+        self.metrics = {"requests": 0, "errors": 0, "reconnects": 0}
+        self._has_connected = False
+
+    async def run(self):
+        retry_in = RECONNECT_INITIAL_DELAY_SEC
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                _, self.connection = await asyncio.wait_for(
+                    loop.create_connection(lambda: FrameProtocol(self._dispatch), self.host, self.port),
+                    timeout=CONNECT_TIMEOUT_SEC)
+                await self.connection.negotiate({"action": "hello"}, self.router.wire_codecs)
+                self.is_connected = True
+                if self._has_connected:
+                    self.metrics["reconnects"] += 1
+                self._has_connected = True
+                retry_in = RECONNECT_INITIAL_DELAY_SEC
+                logger.info(f"✅ Connected to shard worker {self.index} at {self.host}:{self.port}")
+                self.subscribe(self.tags, replay=True)
+                heartbeat = asyncio.create_task(self._heartbeat())
+                try:
+                    await self.connection.closed
+                finally:
+                    heartbeat.cancel()
+            except (ConnectionError, asyncio.TimeoutError, OSError) as e:
+                # Refused connections are expected while a worker is still starting up
+                (logger.warning if self._has_connected else logger.debug)(
+                    f"Shard worker {self.index} at {self.host}:{self.port} unavailable: {e!r}")
+            finally:
+                self.is_connected = False
+                if self.connection:
+                    self.connection.close()
+                for future in self.pending_requests.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError(f"Lost connection to shard worker {self.index}"))
+                self.pending_requests.clear()
+            await asyncio.sleep(retry_in)
+            retry_in = min(retry_in * 2, RECONNECT_MAX_DELAY_SEC)
+
+    def subscribe(self, tags: List[str], replay: bool = False):
+        """Subscribes to the worker's events for `tags`; with `replay`, also to those missed while disconnected."""
+        if not tags:
+            return
+        command = {"action": "subscribe_events", "tags": tags}
+        if replay and self.last_seq is not None:
+            command.update(since_seq=self.last_seq, epoch=self.epoch)
+        self.connection.send(command)
+
+    def _dispatch(self, messages: List[Dict[str, Any]]):
+        for message in messages:
+            if "event" in message:
+                if message.get("seq") is not None:
+                    self.last_seq, self.epoch = message["seq"], message.get("epoch", self.epoch)
+                self.router.event_queue.put_nowait(message)  # Re-sequenced by the router's journal
+            elif message.get("req_id") is not None:
+                future = self.pending_requests.pop(message.pop("req_id"), None)
+                if future and not future.done():
+                    future.set_result(message)
+            elif "subscribed_to_events_for" in message:
+                if self.last_seq is None or message.get("replay_complete") is False:
+                    if self.last_seq is not None:
+                        logger.warning(f"Shard worker {self.index} could not replay every event after "
+                                       f"seq {self.last_seq}; some were lost. Clients will resync.")
+                        # Our own journal cannot vouch for those tags any more
+                        self.router.journal.new_epoch()
+                    self.last_seq, self.epoch = message.get("last_seq"), message.get("epoch")
+
+    async def request(self, command: Dict[str, Any], timeout: float = SHARD_REQUEST_TIMEOUT_SEC) -> Dict[str, Any]:
+        """Sends `command` under a link-local req_id and waits for the worker's reply."""
+        if not self.is_connected:
+            raise ConnectionError(f"Shard worker {self.index} not connected")
+        req_id = next(self._req_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending_requests[req_id] = future
+        self.metrics["requests"] += 1
+        try:
+            self.connection.send({**command, "req_id": req_id})
+            await self.connection.drain()
+            return await asyncio.wait_for(future, timeout=timeout)
+        except (ConnectionError, asyncio.TimeoutError):
+            self.metrics["errors"] += 1
+            raise
+        finally:
+            self.pending_requests.pop(req_id, None)
+
+    async def _heartbeat(self):
+        """Fetches the worker's stats periodically, which also detects a hung worker."""
+        while True:
+            try:
+                self.worker_stats = await self.request({"action": "stats"}, timeout=REQUEST_TIMEOUT_MAX_SEC)
+            except (ConnectionError, asyncio.TimeoutError) as e:
+                logger.warning(f"Shard worker {self.index} heartbeat failed ({e!r}); reconnecting.")
+                self.connection.close()
+                return
+            await asyncio.sleep(HEARTBEAT_INTERVAL_SEC)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"shard": self.index, "connected": self.is_connected, **self.metrics,
+                "in_flight": len(self.pending_requests), "last_seq": self.last_seq}
+
+
+class GatewayRouter(GatewayManager):
+    """
+    Front end of a sharded gateway. Serves the public port exactly like a GatewayManager but runs no MC
+    clients: commands go to the shard worker owning the tag's MC, read_many/write_many are split per
+    worker and merged back in order, and the workers' events are merged into this process's journal.
+    Scheduled writes run here; interlocks run in the workers, next to their MCs.
+    """
+
+    def __init__(self, config_path: str, options: Optional[Dict[str, Any]] = None,
+                 interlocks: Optional[Dict[str, str]] = None):
+        super().__init__(config_path, options)
+        self.worker_interlocks = interlocks or {}
+        self.shard_workers = int(self.options.get("shard_workers", 1))
+        base_port = int(self.options.get("shard_base_port", int(self.options.get("gateway_server_port", 5020)) + 1))
+        self.links = [ShardLink(index, "127.0.0.1", base_port + index, self) for index in range(self.shard_workers)]
+        self.workers: List[Optional[multiprocessing.Process]] = [None] * self.shard_workers
+
+    def load_config(self):
+        logger.info(f"Loading configuration from {self.config_path}")
+        full_config, self.config_digest = self._read_config()
+        self._apply_config(full_config)
+        logger.info(f"Configuration loaded. Routing {len(self.tag_map)} tags to {self.shard_workers} shard workers.")
+
+    def _apply_config(self, full_config: List[Dict]) -> Tuple[List, List, List]:
+        """Maps every tag to the ShardLink of its worker (tag_routes holds links here) and subscribes to new tags."""
+        tag_map: Dict[str, Dict[str, Any]] = {}
+        tag_routes: Dict[str, ShardLink] = {}
+        tags_by_link: Dict[ShardLink, List[str]] = defaultdict(list)
+        for tag in full_config:
+            link = self.links[shard_of(tag.get("micro_controller_ip", "0.0.0.0"),
+                                       int(tag.get("micro_controller_port", 8888)), self.shard_workers)]
+            tag_map[tag['tag_name']] = tag
+            tag_routes[tag['tag_name']] = link
+            tags_by_link[link].append(tag['tag_name'])
+        for name, spec in self.worker_interlocks.items():
+            rule = parse_interlock(name, spec)
+            if len({tag_routes.get(tag) for tag in [rule.tag_name, *(tag for tag, _ in rule.writes)]}) > 1:
+                raise ValueError(f"Interlock '{name}' spans several shard workers; its tags must share one")
+
+        self.tag_map, self.tag_routes = tag_map, tag_routes
+        for link in self.links:
+            new_tags = [tag for tag in tags_by_link[link] if tag not in link.tags]
+            link.tags = tags_by_link[link]
+            if new_tags and link.is_connected:
+                link.subscribe(new_tags)
+        return [], [], []
+
+    def stats(self) -> Dict[str, Any]:
+        microcontrollers, suppressed = {}, {}
+        interlocks, interrupts = defaultdict(int), defaultdict(int)
+        for link in self.links:
+            microcontrollers.update(link.worker_stats.get("microcontrollers", {}))
+            suppressed.update(link.worker_stats.get("suppressed_interrupts", {}))
+            for name, count in link.worker_stats.get("interlocks", {}).items():
+                interlocks[name] += count
+            for name, count in link.worker_stats.get("interrupts", {}).items():
+                interrupts[name] += count
+        return {
+            "event_queue_depth": self.event_queue.qsize(),
+            "event_seq": self.journal.last_seq,
+            "interlocks": dict(interlocks),
+            "interrupts": dict(interrupts),
+            "suppressed_interrupts": suppressed,
+            "pending_schedules": sum(1 for s in self.schedules.values() if s["state"] == "pending"),
+            "microcontrollers": microcontrollers,
+            "shards": [link.stats() for link in self.links],
+        }
+
+    async def start(self):
+        # Parsing first also leaves the parse cache in place for the workers
+        self.load_config()
+        for index in range(self.shard_workers):
+            self._spawn_worker(index)
+        try:
+            await self._serve(*(link.run() for link in self.links), self._supervise_workers())
+        finally:
+            for worker in self.workers:
+                if worker and worker.is_alive():
+                    worker.terminate()
+
+    def _spawn_worker(self, index: int):
+        options = {key: value for key, value in self.options.items()
+                   if key not in ("shard_workers", "metrics_http_port", "event_journal_path")}
+        options.update(gateway_server_ip="127.0.0.1", gateway_server_port=str(self.links[index].port),
+                       shard_index=str(index), shard_count=str(self.shard_workers))
+        worker = multiprocessing.get_context("spawn").Process(
+            target=run_shard_worker, args=(self.config_path, options, self.worker_interlocks),
+            name=f"gateway-shard-{index}", daemon=True)
+        worker.start()
+        self.workers[index] = worker
+        logger.info(f"Started shard worker {index} (pid {worker.pid}) on port {self.links[index].port}")
+
+    async def _supervise_workers(self):
+        while True:
+            await asyncio.sleep(SHARD_WORKER_RESTART_DELAY_SEC)
+            for index, worker in enumerate(self.workers):
+                if not worker.is_alive():
+                    logger.error(f"Shard worker {index} exited with code {worker.exitcode}; restarting it.")
+                    self._spawn_worker(index)
+
+    async def route_command_to_mc(self, command: Dict[str, Any], priority: int = PRIORITY_READ) -> Dict[str, Any]:
+        """Forwards a single-tag command to the worker owning the tag."""
+        tag_name = command.get("tag_name")
+        if not tag_name: return {"status": "error", "message": "Command missing 'tag_name'"}
+
+        link = self.tag_routes.get(tag_name)
+        if not link: return {"status": "error", "message": f"No microcontroller found for tag '{tag_name}'"}
+        try:
+            return await link.request(command)
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            return {"status": "error", "message": f"Shard worker {link.index} failed: {e!r}"}
+
+    async def route_many_to_mcs(self, command: Dict[str, Any], priority: int = PRIORITY_READ) -> Dict[str, Any]:
+        """Splits read_many / write_many per worker, sends the parts concurrently and merges the results in order."""
+        action = command.get("action")
+        key = "tags" if action == "read_many" else "writes"
+        items = command.get(key) or []
+        if not items:
+            return {"status": "error", "message": f"'{action}' needs a non-empty list of tags"}
+        tag_names = [item if action == "read_many" else item.get("tag_name") for item in items]
+
+        groups = defaultdict(list)
+        for index, tag_name in enumerate(tag_names):
+            groups[self.tag_routes.get(tag_name)].append(index)
+
+        results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+
+        async def run_group(link, indexes):
+            if link is None:
+                message = "No microcontroller found for tag"
+            else:
+                try:
+                    response = await link.request({**command, key: [items[i] for i in indexes]})
+                    for index, result in zip(indexes, response["results"]):
+                        results[index] = result
+                    return
+                except (ConnectionError, asyncio.TimeoutError) as e:
+                    message = f"Shard worker {link.index} failed: {e!r}"
+            for index in indexes:
+                results[index] = {"tag_name": tag_names[index], "status": "error", "message": message}
+
+        await asyncio.gather(*(run_group(link, indexes) for link, indexes in groups.items()))
+        all_ok = all(r.get("status") == "ok" for r in results)
+        return {"status": "ok" if all_ok else "error", "results": results}
 
 
 # --- Main Entry Point ---
@@ -359,7 +2073,11 @@ if __name__ == "__main__":
     config = configparser.ConfigParser()
     config.read(config_path)
     config_file_path = config['files']['rtu_config_file']
-    gateway_manager = GatewayManager(config_file_path)
+    gateway_options = dict(config['gateway_server']) if config.has_section('gateway_server') else {}
+    interlocks = dict(config['gateway_interlocks']) if config.has_section('gateway_interlocks') else {}
+    logging.getLogger().setLevel(gateway_options.get("log_level", "INFO").upper())
+    sharded = int(gateway_options.get("shard_workers", 1)) > 1
+    gateway_manager = (GatewayRouter if sharded else GatewayManager)(config_file_path, gateway_options, interlocks)
     try:
         asyncio.run(gateway_manager.start())
     except KeyboardInterrupt:
@@ -1,62 +1,233 @@
 import asyncio
+import itertools
 import json
-from typing import Dict, Any, Optional
+import random
+import time
+from collections import defaultdict
+from typing import Dict, Any, Optional, List, Tuple, Set, NamedTuple, Callable, AsyncIterator
 from utils.AsyncJsonLogger import AsyncJsonLogger
+from utils.rtu_config import is_state_based
+from utils.wire_codec import JSON_CODEC, PREFERRED_CODECS, negotiate_codec
+
+# Default time to wait for the gateway's reply to one command
+COMMAND_TIMEOUT_SEC = 10.0
+# The connection supervisor retries with exponential backoff and jitter; commands issued while it is
+# reconnecting wait up to CONNECT_WAIT_SEC for the connection instead of each starting a connect of its own.
+RECONNECT_INITIAL_DELAY_SEC = 0.5
+RECONNECT_MAX_DELAY_SEC = 10.0
+CONNECT_WAIT_SEC = 5.0
+# Subscribed when no tag list is given (see state_based_tags)
+DEFAULT_SUBSCRIBE_TAGS = ("rd_lid_status_kn1", "rd_motor_status_kn1")
+# Changes buffered per watch() consumer; a consumer that falls behind skips to the newest values
+WATCH_QUEUE_SIZE = 16
+
+
+class TagUpdate(NamedTuple):
+    """One value of a watched tag: from an event ("gpio_interrupt", "poll_change", "resync") or a read ("read")."""
+    tag_name: str
+    value: Any
+    source: str
+    timestamp: float
+
+
+def state_based_tags(rtu_config_path: str) -> List[str]:
+    """Tags the gateway reports by interrupt ("event_report": "State Based") in an RTU config; [] if unreadable."""
+    try:
+        with open(rtu_config_path) as f:
+            tags = json.load(f)
+    except (OSError, ValueError):
+        return []
+    return [tag["tag_name"] for tag in tags if is_state_based(tag)]
 
 
 class AsyncGatewayClient:
-    def __init__(self, host: str, port: int, logger: Optional[AsyncJsonLogger] = None):
-        self.host, self.port, self.lock = host, port, asyncio.Lock()
+    def __init__(self, host: str, port: int, logger: Optional[AsyncJsonLogger] = None,
+                 codecs: Optional[List[str]] = None, subscribe_tags: Optional[List[str]] = None):
+        self.host, self.port = host, port
+        # Tags whose events are subscribed on every (re)connect
+        self.subscribe_tags = list(subscribe_tags or DEFAULT_SUBSCRIBE_TAGS)
+        # Only (re)connecting is serialized; commands themselves are pipelined over the one connection
+        self._connect_lock = asyncio.Lock()
+        self._supervisor_task: Optional[asyncio.Task] = None
+        self._connected, self._disconnected = asyncio.Event(), asyncio.Event()
+        # Binary codecs offered to the gateway on connect; JSON lines if it declines (or codecs=[])
+        self.codecs = list(PREFERRED_CODECS) if codecs is None else codecs
+        self.codec = JSON_CODEC
         self.reader: Optional[asyncio.StreamReader] = None
         self.writer: Optional[asyncio.StreamWriter] = None
         self.is_connected = False
         self._listener_task: Optional[asyncio.Task] = None
-        self.pending_response_future: Optional[asyncio.Future] = None
+        # req_id -> future of every command awaiting its reply; the gateway echoes req_id and may answer out of order
+        self.pending_requests: Dict[int, asyncio.Future] = {}
+        self._req_ids = itertools.count(1)
         self.event_callback = None  # Callback for handling events
+        # Sequence number of the last event seen; a reconnect asks the gateway to replay everything after it
+        self.last_event_seq: Optional[int] = None
+        # Journal epoch of the gateway process that numbered it (changes when the gateway restarts)
+        self.last_event_epoch: Optional[str] = None
+        # Latest known value of every tag seen in an event or read, and the queues of its watch() consumers
+        self.tag_values: Dict[str, TagUpdate] = {}
+        self._watchers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
 
        
         self.logger: AsyncJsonLogger = logger
 
+    def start(self):
+        """Starts the background supervisor that keeps the connection up (idempotent)."""
+        if self._supervisor_task is None or self._supervisor_task.done():
+            self._supervisor_task = asyncio.create_task(self._supervise())
+
+    async def _supervise(self):
+        delay = RECONNECT_INITIAL_DELAY_SEC
+        while True:
+            await self.connect()
+            if self.is_connected:
+                delay = RECONNECT_INITIAL_DELAY_SEC
+                await self._disconnected.wait()
+                continue
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, RECONNECT_MAX_DELAY_SEC)
+
+    async def wait_connected(self, timeout: float = CONNECT_WAIT_SEC) -> bool:
+        """Waits up to `timeout` for the supervisor to (re)connect; starts it if needed."""
+        if not self.is_connected:
+            self.start()
+            try:
+                await asyncio.wait_for(self._connected.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.is_connected
+
     async def connect(self):
+        async with self._connect_lock:
+            if not self.is_connected:
+                await self._connect()
+
+    async def _connect(self):
         if self.logger:
             await self.logger.log("INFO", f"Connecting to gateway at {self.host}:{self.port}...", data={}, is_event=False)
         try:
             self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
-            self.is_connected = True
+            self.codec = await negotiate_codec(self.reader, self.writer, {"action": "hello"}, self.codecs)
             if self.logger:
-                await self.logger.log("INFO", "Connected to gateway.", data={}, is_event=False)
+                await self.logger.log("INFO", f"Connected to gateway ({self.codec.name} framing).", data={}, is_event=False)
 
-            # Subscribe to tags (lid & motor updates)
-            subscribe_cmd = {"action": "subscribe_events", "tags": ["rd_lid_status_kn1", "rd_motor_status_kn1"]}
-            self.writer.write((json.dumps(subscribe_cmd) + "\n").encode())
+            # Subscribe to the configured tags (lid & motor updates by default)
+            subscribe_cmd = {"action": "subscribe_events", "tags": self.subscribe_tags}
+            if self.last_event_seq is not None:
+                subscribe_cmd.update(since_seq=self.last_event_seq, epoch=self.last_event_epoch)
+            self.writer.write(self.codec.encode(subscribe_cmd))
             await self.writer.drain()
 
-            sub_response_data = await asyncio.wait_for(self.reader.readline(), timeout=10.0)
+            sub_response = await asyncio.wait_for(self.codec.read(self.reader), timeout=10.0)
+            sub_response = sub_response or {}
+            # Without a complete replay of what was missed, the current values are read once the listener runs
+            # A gateway that restarted answers with a new epoch; its seq numbers say nothing about ours
+            resync = (self.last_event_seq is None or not sub_response.get("replay_complete", True)
+                      or sub_response.get("epoch") != self.last_event_epoch)
+            if resync:
+                # Fresh start, or the gateway could not replay everything (e.g. it restarted): resume from now on
+                self.last_event_seq = sub_response.get("last_seq")
+                self.last_event_epoch = sub_response.get("epoch")
+                if "replay_complete" in sub_response and self.logger:
+                    await self.logger.log("WARNING", "Gateway could not replay every missed event.",
+                                          data=sub_response, is_event=True)
             if self.logger:
-                await self.logger.log("INFO", f"Subscription response: {sub_response_data.decode().strip()}", data={}, is_event=False)
+                await self.logger.log("INFO", f"Subscription response: {sub_response}", data={}, is_event=False)
 
+            # Commands may only go out once the subscription reply has been read here
+            self.is_connected = True
+            self._disconnected.clear()
             if self._listener_task is None or self._listener_task.done():
                 self._listener_task = asyncio.create_task(self._listen())
+            self._connected.set()
+            if resync:
+                await self._resync()
         except Exception as e:
             if self.logger:
                 await self.logger.log("ERROR", f"Gateway connection failed: {e}", data={}, is_event=True)
             await self._close()
 
+    async def _resync(self):
+        """Bulk-reads the subscribed tags and hands their current values on as "resync" events."""
+        results = await self.read_many(self.subscribe_tags)
+        for tag_name, result in results.items():
+            if result.get("status") == "ok" and "value" in result:
+                self._handle_event({"event": "resync", "tag_name": tag_name, "value": result["value"]})
+
+    def _handle_event(self, message: Dict[str, Any]):
+        if "tag_name" in message and "value" in message:
+            self._publish(TagUpdate(message["tag_name"], message["value"], message["event"],
+                                    message.get("timestamp") or time.time()))
+        if self.event_callback:
+            self.event_callback(message)
+
+    def _publish(self, update: TagUpdate):
+        self.tag_values[update.tag_name] = update
+        for queue in self._watchers.get(update.tag_name, ()):
+            if queue.full():
+                queue.get_nowait()  # Only the newest values matter to a consumer that fell behind
+            queue.put_nowait(update)
+
+    async def watch(self, tag_name: str) -> AsyncIterator[TagUpdate]:
+        """
+        Yields the tag's current value (read from the gateway if none is known yet), then every change.
+        Repeats of the last yielded value are skipped. Only subscribed tags see changes between reads.
+        A consumer that stops early should aclose() the iterator (see wait_for) to unregister at once.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=WATCH_QUEUE_SIZE)
+        self._watchers[tag_name].add(queue)
+        try:
+            current = self.tag_values.get(tag_name)
+            if current is None:
+                await self.read_many([tag_name])
+                current = self.tag_values.get(tag_name)
+            if current is not None:
+                yield current
+            while True:
+                update = await queue.get()
+                if current is None or update.value != current.value:
+                    current = update
+                    yield update
+        finally:
+            self._watchers[tag_name].discard(queue)
+            if not self._watchers[tag_name]:
+                del self._watchers[tag_name]
+
+    async def wait_for(self, tag_name: str, predicate: Callable[[Any], bool], timeout: float) -> Any:
+        """Waits until the tag's value satisfies `predicate` and returns it; raises asyncio.TimeoutError."""
+        async def first_match():
+            updates = self.watch(tag_name)
+            try:
+                async for update in updates:
+                    if predicate(update.value):
+                        return update.value
+            finally:
+                await updates.aclose()
+
+        return await asyncio.wait_for(first_match(), timeout=timeout)
+
     async def _listen(self):
         while self.is_connected:
             try:
-                data = await self.reader.readline()
-                if not data:
+                message = await self.codec.read(self.reader)
+                if message is None:
                     raise ConnectionError("Gateway closed connection")
-                message = json.loads(data.decode().strip())
 
                 if "event" in message:
+                    self.last_event_seq = message.get("seq", self.last_event_seq)
+                    self.last_event_epoch = message.get("epoch", self.last_event_epoch)
                     if self.logger:
                         await self.logger.log("INFO", f"Received event: {message}", data=message, is_event=True)
-                    if self.event_callback:
-                        self.event_callback(message)
-                elif self.pending_response_future and not self.pending_response_future.done():
-                    self.pending_response_future.set_result(message)  # response handling = status
+                    self._handle_event(message)
+                elif self.pending_requests:
+                    # Gateways without req_id support answer in order, so an untagged reply is the oldest request's
+                    req_id = message.pop("req_id", None)
+                    if req_id is None:
+                        req_id = next(iter(self.pending_requests))
+                    future = self.pending_requests.pop(req_id, None)
+                    if future and not future.done():
+                        future.set_result(message)  # response handling = status
                 else:
                     if self.logger:
                         await self.logger.log("WARNING", f"Unexpected response: {message}", data=message, is_event=False)
@@ -64,8 +235,6 @@ class AsyncGatewayClient:
             except Exception as e:
                 if self.logger:
                     await self.logger.log("ERROR", f"Gateway listener error: {e}", data={}, is_event=True)
-                if self.pending_response_future and not self.pending_response_future.done():
-                    self.pending_response_future.set_exception(e)
                 await self._close()
                 break
     """async def send_command(self, command, timeout=3):
@@ -97,33 +266,100 @@ class AsyncGatewayClient:
         except Exception as e:
             return {"error": str(e)}"""
 
-    async def send_command(self, command: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-        async with self.lock:
-            if not self.is_connected:
-                await self.connect()
-                if not self.is_connected:
-                    return None
-            try:
-                message = (json.dumps(command) + "\n").encode()
-                self.writer.write(message)
-                await self.writer.drain()
-
-                self.pending_response_future = asyncio.get_running_loop().create_future()
-                response = await asyncio.wait_for(self.pending_response_future, timeout=10.0)
-                self.pending_response_future = None
-                return response  # status (command response)
-            except Exception as e:
-                if self.logger:
-                    await self.logger.log("ERROR", f"Error sending command: {e}", data=command, is_event=True)
-                await self._close()
-                return None
+    async def send_command(self, command: Dict[str, Any],
+                           timeout: float = COMMAND_TIMEOUT_SEC) -> Optional[Dict[str, Any]]:
+        """
+        Sends a command and waits up to `timeout` for its reply; None if there is none. Any number of commands
+        can be in flight at once, so a slow read never holds up a write. Cancelling the caller abandons the request.
+        """
+        if not await self.wait_connected():
+            return None
+        req_id = next(self._req_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending_requests[req_id] = future
+        try:
+            self.writer.write(self.codec.encode({**command, "req_id": req_id}))
+            await self.writer.drain()
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            # Only this request is given up; the connection and the other requests on it carry on
+            if self.logger:
+                await self.logger.log("ERROR", f"No reply to command within {timeout} s", data=command, is_event=True)
+            return None
+        except Exception as e:
+            if self.logger:
+                await self.logger.log("ERROR", f"Error sending command: {e}", data=command, is_event=True)
+            await self._close()
+            return None
+        finally:
+            self.pending_requests.pop(req_id, None)
+
+    async def read_many(self, tags: List[str], max_age_ms: Optional[float] = None) -> Dict[str, Dict[str, Any]]:
+        """Reads several tags in one gateway round trip. Returns {tag_name: response} for the tags that answered."""
+        command: Dict[str, Any] = {"action": "read_many", "tags": tags}
+        if max_age_ms is not None:
+            command["max_age_ms"] = max_age_ms
+        response = await self.send_command(command)
+        results = {r["tag_name"]: r for r in (response or {}).get("results", [])}
+        for tag_name, result in results.items():
+            if result.get("status") == "ok" and "value" in result:
+                self._publish(TagUpdate(tag_name, result["value"], "read", time.time()))
+        return results
+
+    async def write_many(self, writes: List[Tuple[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Writes several tags in one gateway round trip; writes to the same microcontroller keep their order."""
+        return await self.send_command({
+            "action": "write_many",
+            "writes": [{"tag_name": tag_name, "value": value} for tag_name, value in writes]
+        })
+
+    async def schedule_writes(self, writes: List[Tuple[str, Any]], delay_sec: Optional[float] = None,
+                              at: Optional[float] = None, schedule_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Has the gateway perform the writes (in order) after delay_sec, or at the epoch time `at`,
+        independently of this process. The response carries the schedule_id for extend/cancel/get.
+        """
+        command: Dict[str, Any] = {
+            "action": "schedule_writes",
+            "writes": [{"tag_name": tag_name, "value": value} for tag_name, value in writes]
+        }
+        for key, value in (("delay_sec", delay_sec), ("at", at), ("schedule_id", schedule_id)):
+            if value is not None:
+                command[key] = value
+        return await self.send_command(command)
+
+    async def extend_schedule(self, schedule_id: str, delay_sec: float) -> Optional[Dict[str, Any]]:
+        return await self.send_command({"action": "extend_schedule", "schedule_id": schedule_id, "delay_sec": delay_sec})
+
+    async def cancel_schedule(self, schedule_id: str) -> Optional[Dict[str, Any]]:
+        return await self.send_command({"action": "cancel_schedule", "schedule_id": schedule_id})
+
+    async def get_schedule(self, schedule_id: str) -> Optional[Dict[str, Any]]:
+        return await self.send_command({"action": "get_schedule", "schedule_id": schedule_id})
+
+    async def get_stats(self) -> Optional[Dict[str, Any]]:
+        """Fetches the gateway's metrics: per-microcontroller counters and latency, queue depths, subscriber lag."""
+        return await self.send_command({"action": "stats"})
+
+    async def close(self):
+        """Stops the supervisor and closes the connection."""
+        if self._supervisor_task:
+            self._supervisor_task.cancel()
+            self._supervisor_task = None
+        await self._close()
 
     async def _close(self):
         self.is_connected = False
+        self._connected.clear()
+        self._disconnected.set()
         if self.writer:
             self.writer.close()
             await self.writer.wait_closed()
         self.reader = self.writer = None
-        self.pending_response_future = None
+        self.codec = JSON_CODEC
+        for future in self.pending_requests.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Gateway connection closed"))
+        self.pending_requests.clear()
         if self.logger:
             await self.logger.log("INFO", "Closed gateway connection.", data={}, is_event=False)
@@ -1,9 +1,13 @@
 import asyncio
-import json
 import logging
+import os
+import sys
 import time
 from typing import Dict, Any
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.wire_codec import JSON_CODEC, available_codecs, select_codec  # noqa: E402
+
 # Basic configuration for logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - SIMULATOR - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -23,24 +27,35 @@ class KneaderSimulator:
             "6": None   # Lid Control (Write)
         }
         self.subscribed_pins = set()
-        self.clients = set()
+        # writer -> codec negotiated with that gateway connection
+        self.clients = {}
 
     async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         """Handles an incoming connection from the gateway server."""
         client_addr = writer.get_extra_info('peername')
         logger.info(f"Gateway connected from {client_addr}")
-        self.clients.add(writer)
+        self.clients[writer] = JSON_CODEC
         try:
             while True:
-                data = await reader.readline()
-                if not data:
+                try:
+                    message = await self.clients[writer].read(reader)
+                except ValueError as e:
+                    logger.error(f"Error decoding message: {e}")
+                    continue
+                if message is None:
                     break
                 try:
-                    message = json.loads(data.decode().strip())
                     logger.debug(f"Received from gateway: {message}")
+                    if message.get("cmd") == "hello":
+                        # Reply as a JSON line, then switch this connection to the chosen codec
+                        codec = select_codec(message.get("codecs", []), available_codecs())
+                        writer.write(JSON_CODEC.encode({"status": "ok", "codec": codec.name}))
+                        self.clients[writer] = codec
+                        logger.info(f"Gateway at {client_addr} uses {codec.name} framing")
+                        continue
                     response = await self.process_command(message)
                     if response:
-                        writer.write((json.dumps(response) + "\n").encode())
+                        writer.write(self.clients[writer].encode(response))
                         await writer.drain()
                         logger.debug(f"Sent to gateway: {response}")
                 except Exception as e:
@@ -48,15 +63,24 @@ class KneaderSimulator:
         except ConnectionError:
             logger.info(f"Gateway at {client_addr} disconnected")
         finally:
-            self.clients.remove(writer)
+            self.clients.pop(writer, None)
             writer.close()
             await writer.wait_closed()
 
     async def process_command(self, command: Dict[str, Any]) -> Dict[str, Any]:
-        """Processes commands and returns an appropriate response."""
+        """Processes a command and echoes its req_id (if any) so the gateway can correlate the response."""
+        response = await self._execute_command(command)
+        if response is not None and "req_id" in command:
+            response["req_id"] = command["req_id"]
+        return response
+
+    async def _execute_command(self, command: Dict[str, Any]) -> Dict[str, Any]:
+        """Executes a command and returns an appropriate response."""
         cmd_type = command.get("cmd")
 
-        if cmd_type == "force_lid_close":
+        if cmd_type == "ping":
+            return {"status": "ok", "message": "pong"}
+        elif cmd_type == "force_lid_close":
             logger.info("Force command received. Simulating lid closure.")
             if not self.device_states["1"]:
                 self.device_states["1"] = True
@@ -82,7 +106,7 @@ class KneaderSimulator:
         elif cmd_type == "write":
             pin = str(command.get("pin"))
             value = bool(command.get("value"))
-            print(f"[Simulator] Write request: pin={pin}, value={value}")
+            logger.debug(f"Write request: pin={pin}, value={value}")
             self.device_states[pin] = value
             # MODIFIED: Added handler for lid control on pin 6
             if pin == "3":  # Motor control
@@ -90,6 +114,11 @@ class KneaderSimulator:
             elif pin == "6": # Lid control
                 asyncio.create_task(self.update_lid_status(value))
             return {"status": "ok", "slave_id": command.get("slave_id", 1), "pin": int(pin), "value": value,"io_type":"Write Pin"}
+        elif cmd_type == "modbus_read" and "length" in command:
+            # Block read of `length` consecutive registers starting at `register`
+            start, length = int(command.get("register")), int(command.get("length"))
+            return {"status": "ok", "slave_id": command.get("slave_id", 1), "register": start, "length": length,
+                    "values": [self.device_states.get(str(start + i)) for i in range(length)]}
         elif cmd_type == "modbus_read":
             register = str(command.get("register"))
             if register in self.device_states:
@@ -129,13 +158,12 @@ class KneaderSimulator:
                 "pin": int(pin), "value": value,
                 "timestamp": time.time()
             }
-        message_bytes = (json.dumps(message) + "\n").encode()
-        for client_writer in list(self.clients):
+        for client_writer, codec in list(self.clients.items()):
             try:
-                client_writer.write(message_bytes)
+                client_writer.write(codec.encode(message))
                 await client_writer.drain()
             except ConnectionError:
-                self.clients.remove(client_writer)
+                self.clients.pop(client_writer, None)
 
     async def start_server(self, host: str = "0.0.0.0", port: int = 8888):
         """Starts the simulator's TCP server."""
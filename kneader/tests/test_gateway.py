@@ -0,0 +1,313 @@
+"""
+Gateway tests against the KneaderSimulator over real sockets on 127.0.0.1.
+
+Each test builds its own simulator, GatewayManager and (where needed) GatewayTCPServer from
+rtu_kneader_config.json, pointed at the simulator's port, and runs under asyncio.run.
+
+Usage (from the repository root):
+    python -m pytest -q
+"""
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+
+KNEADER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(KNEADER_DIR, "gateway"))
+sys.path.insert(0, os.path.join(KNEADER_DIR, "simulator"))
+import gatewayserver as gw  # noqa: E402
+from micro_simulator import KneaderSimulator  # noqa: E402
+
+LID_OPEN_STOPS_MOTOR = {"lid_open_stops_motor": "rd_lid_status_kn1 == 0 -> wr_motor_control_kn1 = 0"}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_until(predicate, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "condition not met in time"
+        await asyncio.sleep(0.01)
+
+
+async def start_gateway(tmp_path, interlocks=None, tag_overrides=None):
+    """Simulator plus a GatewayManager connected and subscribed to it; returns (simulator, manager)."""
+    simulator = KneaderSimulator()
+    sim_server = await asyncio.start_server(simulator.handle_client, "127.0.0.1", 0)
+    sim_port = sim_server.sockets[0].getsockname()[1]
+    with open(os.path.join(KNEADER_DIR, "rtu_kneader_config.json")) as f:
+        tags = json.load(f)
+    for tag in tags:
+        tag["micro_controller_ip"], tag["micro_controller_port"] = "127.0.0.1", sim_port
+        tag.update((tag_overrides or {}).get(tag["tag_name"], {}))
+    config_path = tmp_path / "rtu_config.json"
+    config_path.write_text(json.dumps(tags))
+
+    manager = gw.GatewayManager(str(config_path), interlocks=interlocks)
+    manager.load_config()
+    for mc_client in manager.mc_clients.values():
+        asyncio.create_task(mc_client.run())
+    await wait_until(lambda: all(mc.subscribed_at is not None for mc in manager.mc_clients.values()))
+    return simulator, manager
+
+
+async def start_tcp_server(manager) -> int:
+    port = free_port()
+    server = gw.GatewayTCPServer("127.0.0.1", port, manager)
+    manager.top_controller_server = server
+    asyncio.create_task(server.start())
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return port
+        except OSError:
+            await asyncio.sleep(0.01)
+    raise AssertionError("gateway TCP server did not start")
+
+
+class JsonLineClient:
+    """Minimal top-level client speaking JSON lines to the gateway TCP server."""
+
+    def __init__(self, reader, writer):
+        self.reader, self.writer = reader, writer
+
+    @classmethod
+    async def connect(cls, port: int) -> "JsonLineClient":
+        return cls(*await asyncio.open_connection("127.0.0.1", port))
+
+    async def send(self, message):
+        self.writer.write((json.dumps(message) + "\n").encode())
+        await self.writer.drain()
+
+    async def receive(self, timeout: float = 5.0):
+        return json.loads(await asyncio.wait_for(self.reader.readline(), timeout))
+
+    async def receive_event(self, timeout: float = 5.0):
+        while True:
+            message = await self.receive(timeout)
+            if "event" in message:
+                return message
+
+    def close(self):
+        self.writer.close()
+
+
+def test_lid_open_interlock_stops_motor(tmp_path):
+    async def scenario():
+        simulator, manager = await start_gateway(tmp_path, interlocks=LID_OPEN_STOPS_MOTOR)
+        simulator.device_states["1"], simulator.device_states["3"] = True, True  # Lid closed, motor on
+
+        simulator.device_states["1"] = False
+        await simulator.notify_pin_change("1", False)
+        await wait_until(lambda: simulator.device_states["3"] is False)
+        assert manager.interlock_stats == {"fired": 1, "failed": 0}
+
+        # A closing lid does not match the rule
+        simulator.device_states["3"] = True
+        await simulator.notify_pin_change("1", True)
+        await asyncio.sleep(0.2)
+        assert simulator.device_states["3"] is True
+        assert manager.interlock_stats["fired"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_resubscribe_replays_missed_events(tmp_path):
+    async def scenario():
+        simulator, manager = await start_gateway(tmp_path)
+        port = await start_tcp_server(manager)
+        tags = ["rd_lid_status_kn1"]
+
+        client = await JsonLineClient.connect(port)
+        await client.send({"action": "subscribe_events", "tags": tags})
+        reply = await client.receive()
+        assert reply["status"] == "ok"
+        await simulator.notify_pin_change("1", True)
+        event = await client.receive_event()
+        assert (event["tag_name"], event["value"]) == ("rd_lid_status_kn1", True)
+        client.close()
+
+        # Changes while the client is away stay in the journal
+        await simulator.notify_pin_change("1", False)
+        await wait_until(lambda: manager.journal.last_seq > event["seq"])
+
+        client = await JsonLineClient.connect(port)
+        await client.send({"action": "subscribe_events", "tags": tags,
+                           "since_seq": event["seq"], "epoch": event["epoch"]})
+        reply = await client.receive()
+        assert reply["replay_complete"] is True
+        assert reply["replayed"] == 1
+        missed = await client.receive_event()
+        assert (missed["tag_name"], missed["value"], missed["seq"]) == ("rd_lid_status_kn1", False, event["seq"] + 1)
+
+        # Another epoch (a restarted gateway) cannot vouch for what happened in between
+        await client.send({"action": "subscribe_events", "tags": tags, "since_seq": event["seq"], "epoch": "0" * 16})
+        reply = await client.receive()
+        assert reply["replay_complete"] is False
+        client.close()
+
+    asyncio.run(scenario())
+
+
+def test_max_age_read_served_from_cache(tmp_path):
+    async def scenario():
+        simulator, manager = await start_gateway(tmp_path)
+        mc_client = manager.tag_to_mc_map["wr_beep_kn1"]
+        simulator.device_states["4"] = True
+
+        first = await manager.route_command_to_mc({"action": "read", "tag_name": "wr_beep_kn1", "max_age_ms": 1000})
+        assert first["value"] is True and first.get("source") != "cache"
+        requests = mc_client.metrics["requests"]
+
+        simulator.device_states["4"] = False
+        cached = await manager.route_command_to_mc({"action": "read", "tag_name": "wr_beep_kn1", "max_age_ms": 1000})
+        assert (cached["source"], cached["value"]) == ("cache", True)
+        assert mc_client.metrics["requests"] == requests
+
+        # Too old for the caller: read through to the MC
+        await asyncio.sleep(0.05)
+        fresh = await manager.route_command_to_mc({"action": "read", "tag_name": "wr_beep_kn1", "max_age_ms": 10})
+        assert fresh.get("source") != "cache" and fresh["value"] is False
+        assert mc_client.metrics["requests"] == requests + 1
+
+    asyncio.run(scenario())
+
+
+def test_event_fed_tag_stays_fresh_while_subscribed(tmp_path):
+    async def scenario():
+        simulator, manager = await start_gateway(tmp_path)
+        await manager.route_command_to_mc({"action": "read", "tag_name": "rd_lid_status_kn1"})
+        await asyncio.sleep(0.1)
+        mc_client = manager.tag_to_mc_map["rd_lid_status_kn1"]
+        mc_client.last_received_at = time.monotonic()  # Any frame from the MC confirms the value
+
+        cached = await manager.route_command_to_mc({"action": "read", "tag_name": "rd_lid_status_kn1",
+                                                    "max_age_ms": 50})
+        assert cached["source"] == "cache"
+
+        await simulator.notify_pin_change("1", True)
+        await wait_until(lambda: manager.tag_cache["rd_lid_status_kn1"][0] is True)
+        cached = await manager.route_command_to_mc({"action": "read", "tag_name": "rd_lid_status_kn1",
+                                                    "max_age_ms": 50})
+        assert (cached["source"], cached["value"]) == ("cache", True)
+
+    asyncio.run(scenario())
+
+
+def test_scheduled_writes_stop_at_first_failure(tmp_path, monkeypatch):
+    monkeypatch.setattr(gw, "SCHEDULE_RETRY_INTERVAL_SEC", 0.05)
+    monkeypatch.setattr(gw, "SCHEDULE_RETRY_WINDOW_SEC", 0.3)
+
+    async def scenario():
+        simulator, manager = await start_gateway(tmp_path)
+        written = []
+        failures = {"3": 2}  # The motor write fails twice, then succeeds
+        execute = simulator._execute_command
+
+        async def flaky_execute(command):
+            pin = str(command.get("pin"))
+            if command.get("cmd") == "write" and failures.get(pin, 0) > 0:
+                failures[pin] -= 1
+                return {"status": "error", "message": "Write failed"}
+            if command.get("cmd") == "write":
+                written.append(pin)
+            return await execute(command)
+
+        simulator._execute_command = flaky_execute
+        writes = [{"tag_name": "wr_motor_control_kn1", "value": 0}, {"tag_name": "wr_lid_status_kn1", "value": 0}]
+
+        manager.route_schedule_command({"action": "schedule_writes", "schedule_id": "ok", "writes": writes,
+                                        "delay_sec": 0})
+        await wait_until(lambda: manager.schedules["ok"]["state"] == "done")
+        assert written == ["3", "6"]
+
+        # A write that keeps failing holds back everything after it
+        written.clear()
+        failures["3"] = 1000
+        manager.route_schedule_command({"action": "schedule_writes", "schedule_id": "stuck", "writes": writes,
+                                        "delay_sec": 0})
+        await wait_until(lambda: manager.schedules["stuck"]["state"] == "failed")
+        assert written == []
+        assert [r["status"] for r in manager.schedules["stuck"]["results"]] == ["error", "error"]
+
+    asyncio.run(scenario())
+
+
+def test_write_many_keeps_request_order_across_lanes(tmp_path):
+    async def scenario():
+        # wr_lid_status_kn1 is in the safety lane, wr_beep_kn1 in the normal write lane
+        simulator, manager = await start_gateway(tmp_path, tag_overrides={"wr_alarm_kn1": {"collapse_writes": True}})
+        received = []
+        execute = simulator._execute_command
+
+        async def recording_execute(command):
+            if command.get("cmd") == "write":
+                received.append(str(command.get("pin")))
+            return await execute(command)
+
+        simulator._execute_command = recording_execute
+        response = await manager.route_many_to_mcs({"action": "write_many", "writes": [
+            {"tag_name": "wr_beep_kn1", "value": 1}, {"tag_name": "wr_lid_status_kn1", "value": 0}]})
+        assert response["status"] == "ok"
+        assert received == ["4", "6"]
+
+        # A collapse_writes tag is not deferred behind the writes after it
+        received.clear()
+        response = await manager.route_many_to_mcs({"action": "write_many", "writes": [
+            {"tag_name": "wr_alarm_kn1", "value": 1}, {"tag_name": "wr_beep_kn1", "value": 0}]})
+        assert response["status"] == "ok"
+        assert received == ["5", "4"]
+
+    asyncio.run(scenario())
+
+
+def test_singleflight_read_takes_most_urgent_lane(tmp_path):
+    async def scenario():
+        simulator, manager = await start_gateway(tmp_path)
+        mc_client = manager.tag_to_mc_map["wr_beep_kn1"]
+        mc_client.max_in_flight = 0  # Only the safety lane can send
+
+        polled = asyncio.ensure_future(manager.route_command_to_mc({"action": "read", "tag_name": "wr_beep_kn1"},
+                                                                   gw.PRIORITY_POLL))
+        await asyncio.sleep(0.1)
+        assert not polled.done()
+        urgent = await asyncio.wait_for(
+            manager.route_command_to_mc({"action": "read", "tag_name": "wr_beep_kn1"}, gw.PRIORITY_SAFETY), 1.0)
+        assert urgent["status"] == "ok"
+        assert (await polled)["status"] == "ok"
+        assert mc_client.metrics["requests"] == 2  # The subscribe and one shared read
+
+    asyncio.run(scenario())
+
+
+def test_read_after_write_does_not_join_older_read(tmp_path):
+    async def scenario():
+        simulator, manager = await start_gateway(tmp_path)
+        simulator.device_states["4"] = False
+        execute = simulator._execute_command
+
+        async def slow_read(command):
+            if command.get("cmd") == "modbus_read":
+                await asyncio.sleep(0.1)
+            return await execute(command)
+
+        simulator._execute_command = slow_read
+        mc_client = manager.tag_to_mc_map["wr_beep_kn1"]
+        before = asyncio.ensure_future(manager.route_command_to_mc({"action": "read", "tag_name": "wr_beep_kn1"}))
+        await wait_until(lambda: mc_client.in_flight_ids)
+        write = asyncio.ensure_future(manager.route_command_to_mc(
+            {"action": "write", "tag_name": "wr_beep_kn1", "value": 1}))
+        await asyncio.sleep(0)
+        after = await manager.route_command_to_mc({"action": "read", "tag_name": "wr_beep_kn1"})
+        assert (await before)["value"] is False
+        assert (await write)["status"] == "ok"
+        assert after["value"] is True
+
+    asyncio.run(scenario())
@@ -0,0 +1,15 @@
+from typing import Any, Mapping
+
+# event_report values of the RTU tag config are matched case-insensitively: the shipped config spells
+# them "State Based" / "None", hand-written ones often "state based".
+STATE_BASED = "state based"
+
+
+def event_report(tag: Mapping[str, Any]) -> str:
+    """The tag's event_report in lower case, "" when it has none."""
+    return str(tag.get("event_report", "")).lower()
+
+
+def is_state_based(tag: Mapping[str, Any]) -> bool:
+    """True for tags the MC reports by interrupt."""
+    return event_report(tag) == STATE_BASED
@@ -0,0 +1,338 @@
+import asyncio
+import json
+import struct
+from collections import deque
+from typing import Dict, Any, Optional, List, Tuple, Callable
+
+# Optional codecs: each one is only offered when its library is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Binary frames are a 4-byte big-endian payload length followed by the payload. Frames of either
+# framing (JSON lines included) larger than MAX_FRAME_BYTES close the connection.
+LENGTH_PREFIX = struct.Struct(">I")
+MAX_FRAME_BYTES = 1 << 20
+# Binary codecs in order of preference; JSON lines is always the fallback
+PREFERRED_CODECS = ("msgpack", "cbor")
+HELLO_TIMEOUT_SEC = 1.0
+# FrameProtocol stops reading from a peer once this many decoded messages are waiting to be handled
+MAX_INBOX_MESSAGES = 1024
+
+
+class JsonLinesCodec:
+    """Newline-delimited JSON, the format every peer understands. Uses orjson when it is installed."""
+    name = "json"
+
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(message, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+        return (json.dumps(message, separators=(",", ":")) + "\n").encode()
+
+    def decode(self, payload) -> Dict[str, Any]:
+        return orjson.loads(payload) if orjson is not None else json.loads(bytes(payload))
+
+    def split_frame(self, view: memoryview, start: int, scanned: int = 0) -> Optional[Tuple[memoryview, int]]:
+        """
+        Payload of the complete frame at `start` and the offset after it, or None if it is incomplete.
+        `scanned` is where an earlier search for the newline stopped, so a long partial line is not rescanned.
+        """
+        end = view.obj.find(b"\n", max(start, scanned))
+        if end - start > MAX_FRAME_BYTES or (end < 0 and len(view) - start > MAX_FRAME_BYTES):
+            raise ConnectionError(f"JSON line exceeds the {MAX_FRAME_BYTES} byte limit")
+        if end < 0:
+            return None
+        return view[start:end], end + 1
+
+    async def read(self, reader: asyncio.StreamReader) -> Optional[Dict[str, Any]]:
+        """Reads one message; None at end of stream."""
+        line = await reader.readline()
+        if not line:
+            return None
+        return self.decode(line)
+
+
+class LengthPrefixedCodec:
+    """Base for binary codecs: subclasses provide pack/decode for the payload."""
+    name = ""
+
+    def pack(self, message: Dict[str, Any]) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, payload: bytes) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        body = self.pack(message)
+        return LENGTH_PREFIX.pack(len(body)) + body
+
+    def split_frame(self, view: memoryview, start: int, scanned: int = 0) -> Optional[Tuple[memoryview, int]]:
+        """Payload of the complete frame at `start` and the offset after it, or None if it is incomplete."""
+        if len(view) - start < LENGTH_PREFIX.size:
+            return None
+        (length,) = LENGTH_PREFIX.unpack_from(view, start)
+        if length > MAX_FRAME_BYTES:
+            raise ConnectionError(f"Frame of {length} bytes exceeds the {MAX_FRAME_BYTES} byte limit")
+        end = start + LENGTH_PREFIX.size + length
+        if len(view) < end:
+            return None
+        return view[start + LENGTH_PREFIX.size:end], end
+
+    async def read(self, reader: asyncio.StreamReader) -> Optional[Dict[str, Any]]:
+        """Reads one message; None at end of stream."""
+        try:
+            header = await reader.readexactly(LENGTH_PREFIX.size)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise ConnectionError("Connection closed in the middle of a frame header")
+            return None
+        (length,) = LENGTH_PREFIX.unpack(header)
+        if length > MAX_FRAME_BYTES:
+            raise ConnectionError(f"Frame of {length} bytes exceeds the {MAX_FRAME_BYTES} byte limit")
+        try:
+            return self.decode(await reader.readexactly(length))
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Connection closed in the middle of a frame")
+
+
+class MsgpackCodec(LengthPrefixedCodec):
+    name = "msgpack"
+
+    def pack(self, message: Dict[str, Any]) -> bytes:
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, payload: bytes) -> Dict[str, Any]:
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+
+
+class CborCodec(LengthPrefixedCodec):
+    name = "cbor"
+
+    def pack(self, message: Dict[str, Any]) -> bytes:
+        return cbor2.dumps(message)
+
+    def decode(self, payload: bytes) -> Dict[str, Any]:
+        return cbor2.loads(payload)
+
+
+JSON_CODEC = JsonLinesCodec()
+CODECS = {JSON_CODEC.name: JSON_CODEC}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+if cbor2 is not None:
+    CODECS["cbor"] = CborCodec()
+
+
+def available_codecs(preferred=PREFERRED_CODECS) -> List[str]:
+    """The preferred binary codecs that are installed here, in order."""
+    return [name for name in preferred if name in CODECS and name != JSON_CODEC.name]
+
+
+def parse_codec_list(value: Optional[str]) -> List[str]:
+    """Parses a config value like "msgpack, cbor"; an empty value means JSON lines only."""
+    return [name.strip().lower() for name in (value or "").split(",") if name.strip()]
+
+
+def select_codec(offered: List[str], accepted: List[str]):
+    """Server side of the hello: the first codec offered by the peer that we accept, else JSON lines."""
+    for name in offered or ():
+        if name in accepted and name in CODECS:
+            return CODECS[name]
+    return JSON_CODEC
+
+
+async def _read_reply(reader: asyncio.StreamReader) -> Dict[str, Any]:
+    # Events (e.g. interrupts) may already be on the wire ahead of the reply; they are not ours to handle
+    while True:
+        message = await JSON_CODEC.read(reader)
+        if message is None:
+            raise ConnectionError("Peer closed the connection during the codec hello")
+        if "event" not in message:
+            return message
+
+
+async def negotiate_codec(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, hello: Dict[str, Any],
+                          offer: List[str], timeout: float = HELLO_TIMEOUT_SEC):
+    """
+    Client side of the hello. Sends `hello` plus the offered codecs as a JSON line and switches to the
+    codec named in the reply. Peers that do not know the hello answer with an error, which keeps JSON lines.
+    """
+    offer = available_codecs(offer)
+    if not offer:
+        return JSON_CODEC
+    writer.write(JSON_CODEC.encode({**hello, "codecs": offer}))
+    await writer.drain()
+    reply = await asyncio.wait_for(_read_reply(reader), timeout=timeout)
+    if reply.get("status") == "ok" and reply.get("codec") in offer:
+        return CODECS[reply["codec"]]
+    return JSON_CODEC
+
+
+class FrameProtocol(asyncio.Protocol):
+    """
+    Message transport without per-line wakeups: each chunk received is appended to one reusable
+    buffer, every complete frame in it is decoded straight from a memoryview, and the decoded
+    messages are handed over as one batch, either to `on_messages` (called synchronously from the
+    event loop) or to an inbox drained with next_batch(). Also offers the write/drain/close subset
+    of asyncio.StreamWriter, so it can stand in for one.
+    """
+
+    def __init__(self, on_messages: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+                 on_connect: Optional[Callable[['FrameProtocol'], None]] = None, codec=JSON_CODEC):
+        self.on_messages, self.on_connect, self.codec = on_messages, on_connect, codec
+        self.transport: Optional[asyncio.Transport] = None
+        self._buffer = bytearray()
+        # Bytes at the start of the buffer already known to hold no complete frame
+        self._scanned = 0
+        self._inbox: deque = deque()
+        self._inbox_ready = asyncio.Event()
+        self._reading_paused = False
+        # While a hello reply is awaited, parsing stops after it so later frames wait for the new codec
+        self._reply_waiter: Optional[asyncio.Future] = None
+        self._hold = False
+        self._write_paused = False
+        self._drain_waiters: List[asyncio.Future] = []
+        self.closed: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    # --- asyncio.Protocol callbacks ---
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        if self.on_connect:
+            self.on_connect(self)
+
+    def data_received(self, data: bytes):
+        self._buffer += data
+        self._parse()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        error = exc or ConnectionError("Connection closed by peer")
+        if self._reply_waiter and not self._reply_waiter.done():
+            self._reply_waiter.set_exception(error)
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_exception(error)
+        self._drain_waiters.clear()
+        if not self.closed.done():
+            self.closed.set_result(exc)
+        self._inbox_ready.set()
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._drain_waiters.clear()
+
+    # --- Parsing ---
+
+    def _parse(self):
+        if self._hold:
+            return
+        messages, start, scanned = [], 0, self._scanned
+        self._scanned = 0
+        view = memoryview(self._buffer)
+        try:
+            while True:
+                frame = self.codec.split_frame(view, start, scanned)
+                if frame is None:
+                    self._scanned = len(view) - start
+                    break
+                payload, start = frame
+                if not payload or payload == b"\r":
+                    continue  # Blank keep-alive line
+                message = self.codec.decode(payload)
+                if self._reply_waiter is not None and "event" not in message:
+                    self._reply_waiter.set_result(message)
+                    self._reply_waiter, self._hold = None, True
+                    break
+                messages.append(message)
+        finally:
+            # Slices of the view must be gone before the buffer can be resized
+            frame = payload = None
+            view.release()
+            del self._buffer[:start]
+        if not messages:
+            return
+        if self.on_messages:
+            self.on_messages(messages)
+        else:
+            self._inbox.extend(messages)
+            self._inbox_ready.set()
+            if len(self._inbox) >= MAX_INBOX_MESSAGES and not self._reading_paused:
+                self._reading_paused = True
+                self.transport.pause_reading()
+
+    def set_codec(self, codec):
+        """Switches the framing for everything not yet parsed (and everything sent from now on)."""
+        self.codec, self._hold, self._scanned = codec, False, 0
+        self._parse()
+
+    async def negotiate(self, hello: Dict[str, Any], offer: List[str], timeout: float = HELLO_TIMEOUT_SEC):
+        """Client side of the codec hello over this transport; see negotiate_codec."""
+        offer = available_codecs(offer)
+        if not offer:
+            return self.codec
+        self._reply_waiter = asyncio.get_running_loop().create_future()
+        try:
+            self.write(JSON_CODEC.encode({**hello, "codecs": offer}))
+            reply = await asyncio.wait_for(self._reply_waiter, timeout=timeout)
+        finally:
+            self._reply_waiter = None
+        codec = JSON_CODEC
+        if reply.get("status") == "ok" and reply.get("codec") in offer:
+            codec = CODECS[reply["codec"]]
+        self.set_codec(codec)
+        return codec
+
+    async def next_batch(self) -> Optional[List[Dict[str, Any]]]:
+        """Every message received since the last call (waits for at least one); None once the peer is gone."""
+        while not self._inbox:
+            if self.closed.done():
+                return None
+            self._inbox_ready.clear()
+            await self._inbox_ready.wait()
+        batch = list(self._inbox)
+        self._inbox.clear()
+        if self._reading_paused:
+            self._reading_paused = False
+            self.transport.resume_reading()
+        return batch
+
+    # --- StreamWriter-like API ---
+
+    def get_extra_info(self, name: str, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def send(self, message: Dict[str, Any]):
+        self.transport.write(self.codec.encode(message))
+
+    def write(self, data: bytes):
+        self.transport.write(data)
+
+    async def drain(self):
+        if self.closed.done():
+            raise ConnectionError("Connection is closed")
+        if self._write_paused:
+            waiter = asyncio.get_running_loop().create_future()
+            self._drain_waiters.append(waiter)
+            await waiter
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+    async def wait_closed(self):
+        await asyncio.shield(self.closed)